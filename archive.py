@@ -0,0 +1,137 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+from diopter.compiler import CompilationSetting, Language, SourceProgram
+
+from utils import get_ratio
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalized_hash(code: str) -> str:
+    """Hash of the program ignoring comments and formatting"""
+    code = COMMENT_RE.sub(" ", code)
+    code = WHITESPACE_RE.sub(" ", code).strip()
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def setting_key(setting: CompilationSetting) -> str:
+    """Directory name identifying compiler, version, opt level and flags"""
+    key = "-".join(
+        [
+            setting.compiler.project.name.lower(),
+            setting.compiler.revision,
+            setting.opt_level.name,
+            *setting.flags,
+        ]
+    )
+    return re.sub(r"[^\w.=-]", "_", key)
+
+
+class EliteArchive:
+    """Persistent top-K store of the best programs per CompilationSetting.
+
+    Every setting has its own directory with one file per program and an
+    `index.json` mapping the normalized hash of a program to its ratio.
+    """
+
+    def __init__(self, path: str | Path, top_k: int = 20) -> None:
+        self.path = Path(path).absolute()
+        self.top_k = top_k
+
+    def setting_dir(self, setting: CompilationSetting) -> Path:
+        return self.path / setting_key(setting)
+
+    @contextmanager
+    def locked(self, setting: CompilationSetting, shared: bool = False):
+        """Lock the archive of `setting` against other processes, e.g. parallel runs"""
+        directory = self.setting_dir(setting)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_index(self, setting: CompilationSetting) -> dict[str, float]:
+        index_file = self.setting_dir(setting) / "index.json"
+        if not index_file.exists():
+            return {}
+        with open(index_file, "r") as f:
+            return json.load(f)
+
+    def store_index(self, setting: CompilationSetting, index: dict[str, float]):
+        index_file = self.setting_dir(setting) / "index.json"
+        tmp_file = index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, index_file)
+
+    def add(
+        self,
+        program: SourceProgram,
+        setting: CompilationSetting,
+        ratio: float | None = None,
+    ) -> bool:
+        """Add `program` to the archive of `setting`.
+
+        Returns:
+            (bool):
+                True if the program is one of the top-K programs of the setting.
+        """
+        if ratio is None:
+            ratio = get_ratio(program, setting)
+
+        directory = self.setting_dir(setting)
+        digest = normalized_hash(program.code)
+        with self.locked(setting):
+            index = self.load_index(setting)
+            if digest in index:
+                return True
+            index[digest] = ratio
+
+            elites = sorted(index, key=index.get, reverse=True)
+            evicted = elites[self.top_k :]
+            for e in evicted:
+                del index[e]
+            kept = digest in index
+            if kept:
+                with open(directory / f"{digest}.c", "w") as f:
+                    f.write(program.code)
+            # the index must not list removed files, delete them afterwards
+            self.store_index(setting, index)
+            for e in evicted:
+                (directory / f"{e}.c").unlink(missing_ok=True)
+            return kept
+
+    def elites(
+        self, setting: CompilationSetting, n: int | None = None
+    ) -> list[SourceProgram]:
+        """The best `n` archived programs of `setting`, best first"""
+        programs = []
+        with self.locked(setting, shared=True):
+            index = self.load_index(setting)
+            for digest in sorted(index, key=index.get, reverse=True)[:n]:
+                with open(self.setting_dir(setting) / f"{digest}.c", "r") as f:
+                    programs.append(SourceProgram(code=f.read(), language=Language.C))
+        return programs
+
+    def import_experiment(
+        self, experiment_dir: str | Path, setting: CompilationSetting
+    ):
+        """Add the `step_N/best.c` programs of an earlier main.py run"""
+        for best_file in sorted(Path(experiment_dir).glob("step_*/best.c")):
+            with open(best_file, "r") as f:
+                program = SourceProgram(code=f.read(), language=Language.C)
+            try:
+                self.add(program, setting)
+            except Exception as e:
+                logging.info(f"Could not archive {best_file}: {e}")
@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import random
+import resource
+import subprocess
+import time
+from pathlib import Path
+
+from diopter.compiler import CompilationSetting, Language, SourceProgram
+from diopter.generator import CSmithGenerator
+from diopter.sanitizer import Sanitizer
+
+from utils import get_ratio, make_setting
+
+# diopter's defaults, the options of a profile are added to them
+CSMITH_FIXED_OPTIONS = list(CSmithGenerator.fixed_options)
+
+DEFAULT_PROFILE = {
+    "options": ["--stop-by-stmt", "100", "--no-volatiles"],
+    "options_pool": list(CSmithGenerator.default_options_pool),
+    "minimum_length": 10,
+}
+
+# values tried for every option, None means the option is not passed
+SEARCH_SPACE = {
+    "--stop-by-stmt": ["50", "100", "200", "500", "1000"],
+    "--max-funcs": [None, "2", "5", "10"],
+    "--max-block-depth": [None, "2", "3", "5"],
+    "--max-expr-complexity": [None, "3", "5", "10"],
+    "--max-array-dim": [None, "1", "2", "3"],
+}
+# options of the generator's pool are either toggled randomly per program
+# (kept in the pool) or fixed to --<option> / --no-<option>
+POOL_CHOICES = ["random", "on", "off"]
+MINIMUM_LENGTHS = [10, 1000, 5000]
+
+
+def load_profile(path: str | None) -> dict:
+    if path is None:
+        return DEFAULT_PROFILE
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class ProfileCSmithGenerator(CSmithGenerator):
+    """CSmithGenerator with per-instance fixed options.
+
+    CSmithGenerator reads its fixed options from a class attribute that is
+    shared by all generators in the process, so they are kept per instance.
+    """
+
+    def __init__(self, sanitizer: Sanitizer, fixed_options: list[str], **kwargs):
+        super().__init__(sanitizer, **kwargs)
+        self.fixed_options = list(fixed_options)
+
+    def generate_program_impl(self) -> SourceProgram:
+        cmd = [self.csmith] + self.fixed_options
+        for option in self.options:
+            if random.randint(0, 1):
+                cmd.append(f"--{option}")
+            else:
+                cmd.append(f"--no-{option}")
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert result.returncode == 0
+        return SourceProgram(
+            code=result.stdout.decode("utf-8"),
+            language=Language.C,
+            defined_macros=(),
+            include_paths=(),
+            system_include_paths=(self.include_path,),
+            flags=(),
+        )
+
+
+def make_generator(
+    sanitizer: Sanitizer, include_path: str | None, profile: dict
+) -> CSmithGenerator:
+    generator = ProfileCSmithGenerator(
+        sanitizer,
+        CSMITH_FIXED_OPTIONS + profile["options"],
+        include_path=include_path,
+        minimum_length=profile["minimum_length"],
+    )
+    # set directly, an empty pool would be replaced by the default one
+    generator.options = profile.get("options_pool", generator.options)
+    return generator
+
+
+def accept_program(program: SourceProgram) -> bool:
+    """Post-filter applied to every generated program"""
+    return "volatile" not in program.code
+
+
+def generate_filtered(
+    generator: CSmithGenerator, setting: CompilationSetting
+) -> SourceProgram | None:
+    p = generator.generate_program()
+    p = setting.preprocess_program(p, make_compiler_agnostic=True)
+    return p if accept_program(p) else None
+
+
+def sample_profile(rng: random.Random) -> dict:
+    options = ["--no-volatiles"]
+    for option, values in SEARCH_SPACE.items():
+        value = rng.choice(values)
+        if value is not None:
+            options += [option, value]
+
+    options_pool = []
+    for option in CSmithGenerator.default_options_pool:
+        match rng.choice(POOL_CHOICES):
+            case "random":
+                options_pool.append(option)
+            case "on":
+                options.append(f"--{option}")
+            case "off":
+                options.append(f"--no-{option}")
+
+    return {
+        "options": options,
+        "options_pool": options_pool,
+        "minimum_length": rng.choice(MINIMUM_LENGTHS),
+    }
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process and all finished child processes"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def evaluate_profile(
+    profile: dict,
+    setting: CompilationSetting,
+    sanitizer: Sanitizer,
+    include_path: str | None,
+    budget: float,
+) -> dict:
+    """Generate and score programs with `profile` for `budget` CPU seconds"""
+    generator = make_generator(sanitizer, include_path, profile)
+    generated = 0
+    ratios = []
+    generation_time = 0.0
+    start_cpu = cpu_seconds()
+    while cpu_seconds() - start_cpu < budget:
+        start = time.monotonic()
+        p = generate_filtered(generator, setting)
+        generation_time += time.monotonic() - start
+        generated += 1
+        if p is None:
+            continue
+        try:
+            ratios.append(get_ratio(p, setting))
+        except Exception as e:
+            logging.info(f"Failed to compile generated program: {e}")
+    cpu = cpu_seconds() - start_cpu
+
+    yield_per_cpu_second = len(ratios) / cpu
+    mean_ratio = sum(ratios) / len(ratios) if ratios else 0.0
+    return {
+        "generated": generated,
+        "accepted": len(ratios),
+        "cpu_seconds": cpu,
+        "generation_seconds": generation_time,
+        "yield_per_cpu_second": yield_per_cpu_second,
+        "mean_ratio": mean_ratio,
+        "max_ratio": max(ratios, default=0.0),
+        # ratio mass produced per CPU second, what the initial pool needs
+        "score": yield_per_cpu_second * mean_ratio,
+    }
+
+
+def tune(
+    setting: CompilationSetting,
+    include_path: str | None,
+    trials: int,
+    budget: float,
+    seed: int | None = None,
+) -> dict:
+    """Random search over CSmith options, returns the best profile"""
+    rng = random.Random(seed)
+    sanitizer = Sanitizer()
+    candidates = [DEFAULT_PROFILE] + [sample_profile(rng) for _ in range(trials - 1)]
+
+    results = []
+    for i, profile in enumerate(candidates):
+        stats = evaluate_profile(profile, setting, sanitizer, include_path, budget)
+        logging.info(f"Trial {i}: {' '.join(profile['options'])} -> {stats}")
+        results.append({**profile, "stats": stats})
+
+    best = max(results, key=lambda r: r["stats"]["score"])
+    return {**best, "trials": results}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Search CSmith options that produce good seeds fast"
+    )
+    parser.add_argument(
+        "--opt-level",
+        type=str,
+        choices=["O0", "O1", "O2", "O3", "Os", "Oz"],
+        default="O0",
+    )
+    parser.add_argument("--compiler", type=str, choices=["gcc", "clang"], default="gcc")
+    parser.add_argument("--csmith-include-path", type=str)
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument(
+        "--budget", type=float, default=60, help="CPU seconds spent per trial"
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--out",
+        type=str,
+        help="Where to store the profile, defaults to csmith_<compiler>_<opt-level>.json",
+    )
+    args = parser.parse_args()
+
+    setting = make_setting(args.compiler, args.opt_level)
+    profile = tune(
+        setting, args.csmith_include_path, args.trials, args.budget, args.seed
+    )
+    profile["setting"] = {"compiler": args.compiler, "opt_level": args.opt_level}
+
+    out = Path(
+        args.out if args.out else f"csmith_{args.compiler}_{args.opt_level}.json"
+    )
+    with open(out, "w") as f:
+        json.dump(profile, f, indent=2)
+    logging.info(f"Best profile {' '.join(profile['options'])} stored in {out}")
@@ -0,0 +1,442 @@
+import argparse
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+from multiprocessing import cpu_count
+from pathlib import Path
+from typing import Callable
+
+from diopter.compiler import CompilationSetting, CompileError, Language, SourceProgram
+from diopter.sanitizer import Sanitizer
+from static_globals.instrumenter import annotate_with_static
+
+from pch import PrecompiledPreamble
+from predictor import RatioPredictor
+from reducer import CreduceReducer, ReduceBinaryRatio
+from utils import get_best_program, get_ratio, get_ratios, make_setting
+
+
+def setting_from_spec(spec: dict) -> CompilationSetting:
+    """Rebuild a CompilationSetting from its job description"""
+    return make_setting(spec["compiler"], spec["opt_level"], tuple(spec["flags"]))
+
+
+def verified_ratio(
+    code: str, setting: CompilationSetting, sanitizer: Sanitizer
+) -> float | None:
+    """Ratio of a program sent by a worker, recomputed by the coordinator.
+
+    Workers are not trusted, None if the program does not pass the sanitizer
+    or does not compile.
+    """
+    program = SourceProgram(code=code, language=Language.C)
+    if not sanitizer.sanitize(program):
+        return None
+    try:
+        return get_ratio(program, setting)
+    except CompileError:
+        return None
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class CoordinatorError(ConnectionError):
+    """The coordinator rejected a message"""
+
+
+def send_message(host: str, port: int, message: dict, timeout: float = 30) -> dict:
+    """Send one JSON message to the coordinator and wait for its answer"""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        f = sock.makefile("rw")
+        f.write(json.dumps(message) + "\n")
+        f.flush()
+        answer = json.loads(f.readline())
+    if "error" in answer:
+        raise CoordinatorError(answer["error"])
+    return answer
+
+
+class Coordinator:
+    """Owns the job queue and hands out jobs to workers over TCP.
+
+    The protocol is one JSON object per connection in each direction. Workers
+    register, poll for jobs, send results and send heartbeats from a separate
+    thread. Jobs of workers that miss heartbeats for longer than
+    `heartbeat_timeout` seconds are put back into the queue.
+
+    Results of workers are sanitized, i.e., compiled and run, on the
+    coordinator, so every message must carry the shared `token`. Without a
+    token the coordinator only listens on a loopback interface.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 0,
+        heartbeat_timeout: float = 60,
+        token: str | None = None,
+    ):
+        if not token and not is_loopback(host):
+            raise ValueError(f"A token is required to listen on {host}")
+        self.token = token
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lock = threading.Condition()
+        self.queue: deque[str] = deque()
+        self.jobs: dict[str, dict] = {}
+        self.results: dict[str, dict] = {}
+        self.running: dict[str, str] = {}
+        self.workers: dict[str, float] = {}
+        self.worker_ids = itertools.count()
+        self.stopped = threading.Event()
+
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    answer = coordinator.handle(json.loads(self.rfile.readline()))
+                except (ValueError, KeyError, TypeError, PermissionError) as e:
+                    logging.info(f"Rejected message from {self.client_address}: {e!r}")
+                    answer = {"error": repr(e)}
+                self.wfile.write((json.dumps(answer) + "\n").encode())
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.shutdown()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.reap_workers, daemon=True).start()
+        logging.info(f"Coordinator listening on {self.address[0]}:{self.address[1]}")
+
+    def shutdown(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, message: dict) -> dict:
+        if self.token and not hmac.compare_digest(
+            str(message.get("token", "")).encode(), self.token.encode()
+        ):
+            raise PermissionError("Invalid token")
+        with self.lock:
+            kind = message["type"]
+            if kind == "register":
+                worker_id = f"{message.get('name', 'worker')}-{next(self.worker_ids)}"
+                self.workers[worker_id] = time.monotonic()
+                logging.info(f"Worker {worker_id} registered")
+                return {"worker_id": worker_id}
+
+            worker_id = message["worker_id"]
+            if worker_id not in self.workers:
+                logging.info(f"Worker {worker_id} is back")
+            self.workers[worker_id] = time.monotonic()
+
+            if kind == "heartbeat":
+                return {"stop": self.stopped.is_set()}
+            if kind == "get_job":
+                if not self.queue:
+                    return {"job": None, "stop": self.stopped.is_set()}
+                job_id = self.queue.popleft()
+                self.running[job_id] = worker_id
+                return {"job": self.jobs[job_id]}
+            if kind == "result":
+                job_id = message["job_id"]
+                # a re-queued job may be finished twice, keep the first result
+                if job_id in self.jobs and job_id not in self.results:
+                    self.results[job_id] = message["result"]
+                    self.running.pop(job_id, None)
+                    if job_id in self.queue:
+                        self.queue.remove(job_id)
+                    self.lock.notify_all()
+                return {}
+            raise ValueError(f"Unknown message type {kind!r}")
+
+    def reap_workers(self):
+        while not self.stopped.wait(self.heartbeat_timeout / 4):
+            with self.lock:
+                now = time.monotonic()
+                for worker_id, last_seen in list(self.workers.items()):
+                    if now - last_seen <= self.heartbeat_timeout:
+                        continue
+                    logging.info(f"Worker {worker_id} lost, re-queue its jobs")
+                    del self.workers[worker_id]
+                    for job_id, owner in list(self.running.items()):
+                        if owner == worker_id:
+                            del self.running[job_id]
+                            self.queue.appendleft(job_id)
+                    # wake up `wait` to notice that no worker is left
+                    self.lock.notify_all()
+
+    @property
+    def n_workers(self) -> int:
+        with self.lock:
+            return len(self.workers)
+
+    def wait_for_workers(self, n: int, timeout: float | None = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.n_workers < n:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def submit(self, kind: str, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"job_id": job_id, "kind": kind, "payload": payload}
+            self.queue.append(job_id)
+        return job_id
+
+    def wait(self, job_ids: list[str], timeout: float | None = None) -> list[dict]:
+        """Block until all jobs are finished and return their results in order.
+
+        Raises:
+            RuntimeError:
+                if all workers are lost or `timeout` seconds passed while jobs
+                are still unfinished
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while not all(j in self.results for j in job_ids):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not self.workers or (remaining is not None and remaining <= 0):
+                    self.cancel(job_ids)
+                    if not self.workers:
+                        raise RuntimeError(
+                            "All workers are lost, jobs are still pending"
+                        )
+                    raise RuntimeError(f"Jobs did not finish within {timeout}s")
+                self.lock.wait(remaining)
+            results = [self.results.pop(j) for j in job_ids]
+            for j in job_ids:
+                del self.jobs[j]
+            return results
+
+    def cancel(self, job_ids: list[str]):
+        """Forget the jobs, late results for them are ignored"""
+        with self.lock:
+            for j in job_ids:
+                self.jobs.pop(j, None)
+                self.results.pop(j, None)
+                self.running.pop(j, None)
+                if j in self.queue:
+                    self.queue.remove(j)
+
+    def map(
+        self, kind: str, payloads: list[dict], timeout: float | None = None
+    ) -> list[dict]:
+        return self.wait([self.submit(kind, p) for p in payloads], timeout)
+
+
+def score_job(payload: dict) -> dict:
+    setting = setting_from_spec(payload["setting"])
+    programs = [
+        SourceProgram(code=code, language=Language.C) for code in payload["codes"]
+    ]
+    return {"ratios": get_ratios(programs, setting)}
+
+
+def reduce_job(payload: dict, default_jobs: int | None = None) -> dict:
+    """Reduce one program with the reducer settings of the coordinator.
+
+    `default_jobs` is used if the coordinator does not set the number of
+    creduce jobs, e.g. to share a host between several workers.
+    """
+    setting = setting_from_spec(payload["setting"])
+    sanitizer = Sanitizer()
+    reducer = CreduceReducer(
+        payload.get("reducer"),
+        jobs=payload.get("jobs") or default_jobs,
+        test_timeout=payload.get("test_timeout"),
+    )
+    predictor = None
+    if payload.get("predictor") is not None:
+        predictor = RatioPredictor.from_dict(payload["predictor"])
+    program = annotate_with_static(
+        SourceProgram(code=payload["code"], language=Language.C)
+    )
+
+    with tempfile.TemporaryDirectory() as outdir:
+        outdir = Path(outdir)
+        tmpdir = outdir / "tmp"
+        tmpdir.mkdir()
+        pass_group_file = None
+        if payload.get("pass_group") is not None:
+            pass_group_file = outdir / "passes.json"
+            with open(pass_group_file, "w") as f:
+                json.dump(payload["pass_group"], f)
+        preamble = None
+        if payload.get("pch"):
+            preamble = PrecompiledPreamble.from_csmith(
+                setting, outdir / "pch", payload.get("csmith_include_path")
+            )
+
+        best_program, best_ratio = program, get_ratio(program, setting, preamble)
+        reduced = reducer.reduce(
+            program,
+            ReduceBinaryRatio(
+                sanitizer,
+                best_ratio,
+                setting,
+                save_temps=True,
+                tmpdir=tmpdir,
+                binary_threshold=payload["threshold"],
+                predictor=predictor,
+                preamble=preamble,
+            ),
+            outdir=outdir,
+            timeout=payload["timeout"],
+            pass_group_file=pass_group_file,
+            pass_timeout=payload.get("pass_timeout"),
+        )
+        step_program, step_ratio = get_best_program(tmpdir, setting)
+
+    if step_ratio > best_ratio:
+        best_program, best_ratio = step_program, step_ratio
+    if reduced is not None and get_ratio(reduced, setting) > best_ratio:
+        best_program, best_ratio = reduced, get_ratio(reduced, setting)
+    return {"code": best_program.code, "ratio": best_ratio}
+
+
+HANDLERS: dict[str, Callable[[dict], dict]] = {
+    "score": score_job,
+    "reduce": reduce_job,
+}
+
+
+class Worker:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        handlers: dict[str, Callable[[dict], dict]] = HANDLERS,
+        heartbeat_interval: float = 10,
+        poll_interval: float = 1,
+        token: str | None = None,
+    ):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.handlers = handlers
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.worker_id = self.send({"type": "register", "name": socket.gethostname()})[
+            "worker_id"
+        ]
+
+    def send(self, message: dict) -> dict:
+        if hasattr(self, "worker_id"):
+            message["worker_id"] = self.worker_id
+        if self.token:
+            message["token"] = self.token
+        return send_message(self.host, self.port, message)
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                if self.send({"type": "heartbeat"}).get("stop"):
+                    self.stopped.set()
+            except OSError as e:
+                logging.info(f"Heartbeat failed: {e}")
+
+    def run(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        while not self.stopped.is_set():
+            try:
+                answer = self.send({"type": "get_job"})
+            except OSError:
+                logging.info("Coordinator is gone, stop worker")
+                break
+            if answer.get("stop"):
+                break
+            job = answer["job"]
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            logging.info(
+                f"Worker {self.worker_id} runs {job['kind']} job {job['job_id']}"
+            )
+            try:
+                result = self.handlers[job["kind"]](job["payload"])
+            except Exception as e:
+                logging.exception(f"Job {job['job_id']} failed")
+                result = {"error": str(e)}
+            try:
+                self.send({"type": "result", "job_id": job["job_id"], "result": result})
+            except OSError as e:
+                # stop heartbeating so that the coordinator re-queues the job
+                logging.info(f"Failed to send result of job {job['job_id']}: {e}")
+                break
+        self.stopped.set()
+
+
+def run_worker(host: str, port: int, jobs: int | None = None, token: str | None = None):
+    handlers = {**HANDLERS, "reduce": partial(reduce_job, default_jobs=jobs)}
+    Worker(host, port, handlers, token=token).run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Start workers for a main.py coordinator"
+    )
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument(
+        "--token",
+        type=str,
+        default=os.environ.get("AST_COORDINATOR_TOKEN"),
+        help="Shared secret of the coordinator, defaults to $AST_COORDINATOR_TOKEN",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of workers to start on this host",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="creduce jobs per worker if the coordinator sets none, "
+        "defaults to the cores divided by --processes",
+    )
+    args = parser.parse_args()
+    jobs = args.jobs if args.jobs else max(1, cpu_count() // args.processes)
+
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(args.host, args.port, jobs, args.token)
+        )
+        for _ in range(args.processes)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
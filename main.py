@@ -1,9 +1,11 @@
 import argparse
+import json
 import logging
 import os
 from datetime import datetime
-from functools import partial
+from multiprocessing import cpu_count
 from pathlib import Path
+from statistics import median
 
 from diopter.compiler import (
     CompilationSetting,
@@ -12,18 +14,32 @@ from diopter.compiler import (
     OptLevel,
     SourceProgram,
 )
-from diopter.generator import CSmithGenerator
 from diopter.sanitizer import Sanitizer
 from static_globals.instrumenter import annotate_with_static
 
+from archive import EliteArchive
+from csmith_tuning import generate_filtered, load_profile, make_generator
+from distributed import Coordinator, is_loopback, verified_ratio
+from metrics import MetricsReporter, experiment_metrics
+from pch import PrecompiledPreamble
+from predictor import (
+    RatioPredictor,
+    extract_features,
+    load_observations,
+    record_observation,
+)
 from reducer import CreduceReducer, ReduceBinaryRatio
-from utils import get_ratio
+from seed_search import stream_seed_search
+from utils import get_best_program, get_ratio, get_ratios
+from utils_passes import write_fast_pass_file
 
 COMPILER = {
     "gcc": CompilerExe.get_system_gcc(),
     "clang": CompilerExe.get_system_clang(),
 }
 
+PASS_DATA = Path(__file__).parent / "pass_data"
+
 
 def setup_experiment_folder(outdir: str):
     parent = Path(outdir).absolute()
@@ -41,24 +57,227 @@ def log_arguments(experiment_dir, args):
             f.write(f"{arg}: {getattr(args, arg)}\n")
 
 
-def get_best_program(program_dir: str, setting: CompilationSetting):
-    best_ratio = 0
-    best_program = None
-    for file in os.listdir(program_dir):
-        with open(os.path.join(program_dir, file), "r") as f:
-            p = SourceProgram(
-                code=f.read(),
-                language=Language.C,
+def fit_predictor(args, observation_files):
+    predictor = RatioPredictor(
+        confidence=args.predictor_confidence,
+        min_samples=args.predictor_min_samples,
+        audit_rate=args.predictor_audit_rate,
+    )
+    return predictor.fit(load_observations(*observation_files))
+
+
+def log_pch_hit_rate(observation_file, step):
+    """Log how many compiles used the precompiled preamble and their median time"""
+    records = [
+        r
+        for r in load_observations(observation_file)
+        if r.get("pch") is not None and r.get("compile_time") is not None
+    ]
+    hits = [r["compile_time"] for r in records if r["pch"]]
+    misses = [r["compile_time"] for r in records if not r["pch"]]
+    with_pch = f"{median(hits):.3f}s" if hits else "-"
+    without_pch = f"{median(misses):.3f}s" if misses else "-"
+    logging.info(
+        f"Step {step}: {len(hits)} of {len(records)} compiles used the precompiled "
+        f"preamble, median compile time {with_pch} with and {without_pch} without"
+    )
+
+
+def log_predictor_report(experiment_dir, predictor, observation_file, step):
+    report = predictor.report(load_observations(observation_file))
+    logging.info(f"Predictor report after step {step}: {report}")
+    with open(experiment_dir / "predictor.log", "a") as f:
+        f.write(f"step {step}: {report}\n")
+
+
+def score_seeds(programs, setting, seed_file):
+    scored = []
+    for p, ratio in zip(programs, get_ratios(programs, setting)):
+        if ratio is None:
+            continue
+        record_observation(seed_file, extract_features(p.code), ratio, 0, True)
+        scored.append((ratio, p))
+    return scored
+
+
+def select_initial_program(program_pool, setting, predictor, seed_file, scored=()):
+    """Best of the `program_pool` and the already `scored` (ratio, program) seeds"""
+    scored = list(scored)
+    for ratio, p in scored:
+        record_observation(seed_file, extract_features(p.code), ratio, 0, True)
+
+    if predictor is None or not predictor.ready:
+        scored += score_seeds(program_pool, setting, seed_file)
+    else:
+        # compile the seeds the predictor ranks highest first, the others only
+        # if their upper confidence bound can still beat the best of those
+        ranked = sorted(
+            ((predictor.predict(p), p) for p in program_pool),
+            key=lambda x: x[0],
+            reverse=True,
+        )
+        head = max(1, len(ranked) // 4)
+        scored += score_seeds([p for _, p in ranked[:head]], setting, seed_file)
+        best_ratio = max((ratio for ratio, _ in scored), default=0)
+        rest = [
+            p
+            for predicted, p in ranked[head:]
+            if predictor.upper_bound(predicted) >= best_ratio
+        ]
+        logging.info(
+            f"Predictor skipped {len(ranked) - head - len(rest)} of {len(ranked)} seeds"
+        )
+        scored += score_seeds(rest, setting, seed_file)
+
+    if not scored:
+        return None
+    return max(scored, key=lambda x: x[0])[1]
+
+
+def best_verified(candidates, verified, setting, sanitizer):
+    """Best candidate whose ratio was computed locally.
+
+    Ratios reported by workers are only used for ranking, the best candidate
+    is recomputed here until the best one is a verified one.
+    """
+    while candidates:
+        code = max(candidates, key=candidates.get)
+        if code in verified:
+            return code
+        ratio = verified_ratio(code, setting, sanitizer)
+        if ratio is None:
+            logging.warning("Dropping candidate that failed verification")
+            del candidates[code]
+        else:
+            candidates[code] = ratio
+            verified.add(code)
+    return None
+
+
+def run_distributed(
+    args,
+    setting,
+    sanitizer,
+    program_pool,
+    scored,
+    experiment_root,
+    archive,
+    metrics,
+    predictor,
+    pass_group_file,
+):
+    """Search loop where reductions and scoring run on remote workers.
+
+    Every round the best `args.workers` distinct programs are reduced in
+    parallel, one reduction job per worker. Nothing a worker reports is
+    trusted: reduced programs are sanitized and their ratio is recomputed
+    before they become candidates.
+    """
+    setting_spec = {
+        "compiler": args.compiler,
+        "opt_level": args.opt_level,
+        "flags": list(setting.flags),
+    }
+    # the workers reduce with the same settings as a local run
+    reducer_spec = {
+        "reducer": args.reducer,
+        "jobs": args.jobs,
+        "test_timeout": args.test_timeout,
+        "pass_group": None,
+        "pass_timeout": args.pass_timeout,
+        "pch": args.pch,
+        "csmith_include_path": args.csmith_include_path,
+        "predictor": predictor.to_dict() if predictor is not None else None,
+    }
+    if pass_group_file is not None:
+        with open(pass_group_file, "r") as f:
+            reducer_spec["pass_group"] = json.load(f)
+
+    with Coordinator(
+        args.coordinator_host, args.coordinator_port, token=args.coordinator_token
+    ) as coordinator:
+        logging.info(f"Waiting for {args.workers} workers")
+        coordinator.wait_for_workers(args.workers)
+
+        # one batch per worker, workers compile their batch with get_ratios
+        batches = [program_pool[w :: args.workers] for w in range(args.workers)]
+        scores = coordinator.map(
+            "score",
+            [
+                {"codes": [p.code for p in batch], "setting": setting_spec}
+                for batch in batches
+                if batch
+            ],
+        )
+        candidates = {
+            p.code: ratio
+            for batch, s in zip(batches, scores)
+            for p, ratio in zip(batch, s.get("ratios", []))
+            if isinstance(ratio, float)
+        }
+        # computed by the local seed search
+        candidates.update((p.code, ratio) for ratio, p in scored)
+        verified = {p.code for _, p in scored}
+
+        rounds_no_improvement = 0
+        for i in range(args.rounds):
+            if rounds_no_improvement >= args.max_rounds_no_improvement:
+                break
+
+            best_code = best_verified(candidates, verified, setting, sanitizer)
+            if best_code is None:
+                logging.error("No valid candidate left")
+                return
+            best_ratio = candidates[best_code]
+            if metrics is not None:
+                metrics.set("round", i + 1)
+                metrics.set(
+                    "best_ratio",
+                    best_ratio,
+                    compiler=args.compiler,
+                    opt_level=args.opt_level,
+                )
+            frontier = sorted(candidates, key=candidates.get, reverse=True)
+            results = coordinator.map(
+                "reduce",
+                [
+                    {
+                        "code": code,
+                        "setting": setting_spec,
+                        "threshold": args.threshold,
+                        "timeout": args.timeout,
+                        **reducer_spec,
+                    }
+                    for code in frontier[: args.workers]
+                ],
             )
-            try:
-                current_ratio = get_ratio(p, setting)
-                if current_ratio > best_ratio:
-                    best_ratio = current_ratio
-                    best_program = p
-            except:
-                continue
+            for r in results:
+                code = r.get("code")
+                if not isinstance(code, str) or code in verified:
+                    continue
+                ratio = verified_ratio(code, setting, sanitizer)
+                if ratio is None:
+                    logging.warning("Dropping reduced program that failed verification")
+                    continue
+                candidates[code] = ratio
+                verified.add(code)
 
-    return best_program, best_ratio
+            best_code = best_verified(candidates, verified, setting, sanitizer)
+            if candidates[best_code] - best_ratio < args.min_improvement_per_round:
+                rounds_no_improvement += 1
+            else:
+                rounds_no_improvement = 0
+
+            iteration_dir = experiment_root / f"step_{i+1}"
+            iteration_dir.mkdir()
+            with open(iteration_dir / "best.c", "w") as f:
+                f.write(best_code)
+            if archive is not None:
+                archive.add(
+                    SourceProgram(code=best_code, language=Language.C),
+                    setting,
+                    candidates[best_code],
+                )
 
 
 def main(args):
@@ -69,28 +288,108 @@ def main(args):
     )
 
     sanitizer = Sanitizer()
-    generator = CSmithGenerator(
-        sanitizer=sanitizer,
-        include_path=args.csmith_include_path,
-        minimum_length=10,
-    )
-    generator.fixed_options += ["--stop-by-stmt", "100", "--no-volatiles"]
+    profile = load_profile(args.csmith_profile)
+    if profile.get("setting", {}) not in (
+        {},
+        {"compiler": args.compiler, "opt_level": args.opt_level},
+    ):
+        logging.warning(f"CSmith profile was tuned for {profile['setting']}")
+    generator = make_generator(sanitizer, args.csmith_include_path, profile)
 
-    reducer = CreduceReducer()
+    reducer = CreduceReducer(
+        args.reducer, jobs=args.jobs, test_timeout=args.test_timeout
+    )
 
+    # seeds the seed search already compiled are not compiled again
+    scored = []
     program_pool = []
-    generated = 0
-    while generated < args.initial_programs:
-        p = generator.generate_program()
-        p = setting.preprocess_program(p, make_compiler_agnostic=True)
-        if not "volatile" in p.code:
-            program_pool.append(p)
-            generated += 1
-    p = max(program_pool, key=partial(get_ratio, setting=setting))
+    if args.seed_time_budget or args.seed_cpu_budget or args.seed_patience:
+        scored = stream_seed_search(
+            generator,
+            setting,
+            top_k=args.seed_top_k,
+            time_budget=args.seed_time_budget,
+            cpu_budget=args.seed_cpu_budget,
+            patience=args.seed_patience,
+            binary_size_slack=args.seed_size_slack,
+        )
+    else:
+        generated = 0
+        while generated < args.initial_programs:
+            p = generate_filtered(generator, setting)
+            if p is not None:
+                program_pool.append(p)
+                generated += 1
+
+    archive = None
+    if args.archive:
+        archive = EliteArchive(args.archive, top_k=args.archive_top_k)
+        for experiment_dir in args.archive_import:
+            archive.import_experiment(experiment_dir, setting)
+        elites = archive.elites(setting, args.seed_from_archive)
+        logging.info(f"Add {len(elites)} archived programs to the initial pool")
+        program_pool += elites
 
     rounds_no_improvement = 0
     experiment_root = setup_experiment_folder(args.out)
     log_arguments(experiment_root, args)
+
+    pass_group_file = args.pass_group_file
+    if args.fast_passes:
+        pass_group_file = experiment_root / "fast_passes.json"
+        write_fast_pass_file(
+            pass_group_file,
+            PASS_DATA / "all.json",
+            PASS_DATA / "fast_maybe_useful.json",
+        )
+
+    predictor = None
+    observation_file = experiment_root / "observations.jsonl"
+    seed_file = experiment_root / "seed_observations.jsonl"
+    if args.predictor:
+        predictor = fit_predictor(args, args.predictor_data)
+
+    metrics = None
+    if args.metrics_textfile or args.metrics_port:
+        metrics = experiment_metrics()
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        reporter = MetricsReporter(
+            metrics,
+            observation_file,
+            jobs=args.jobs if args.jobs else cpu_count(),
+            textfile=args.metrics_textfile,
+            interval=args.metrics_interval,
+        )
+        reporter.start()
+    if args.workers:
+        run_distributed(
+            args,
+            setting,
+            sanitizer,
+            program_pool,
+            scored,
+            experiment_root,
+            archive,
+            metrics,
+            predictor,
+            pass_group_file,
+        )
+        if metrics is not None:
+            reporter.stop()
+        return
+    p = select_initial_program(program_pool, setting, predictor, seed_file, scored)
+
+    preamble = None
+    if args.pch:
+        preamble = PrecompiledPreamble.from_csmith(
+            setting, experiment_root / "pch", args.csmith_include_path
+        )
+        # creduce soon removes unused parts of the preamble, candidates that do
+        # not start with it anymore are compiled in full, see log_pch_hit_rate
+        if preamble.split(p) is None:
+            logging.warning("Initial program does not start with the CSmith preamble")
+
     for i in range(args.rounds):
         if rounds_no_improvement >= args.max_rounds_no_improvement:
             break
@@ -101,8 +400,16 @@ def main(args):
         tmpdir.mkdir()
 
         p = annotate_with_static(p)
-        best_ratio = get_ratio(p, setting)
-        p = reducer.reduce(
+        best_ratio = get_ratio(p, setting, preamble)
+        if metrics is not None:
+            metrics.set("round", i + 1)
+            metrics.set(
+                "best_ratio",
+                best_ratio,
+                compiler=args.compiler,
+                opt_level=args.opt_level,
+            )
+        result = reducer.run(
             p,
             ReduceBinaryRatio(
                 sanitizer,
@@ -111,29 +418,91 @@ def main(args):
                 save_temps=True,
                 tmpdir=tmpdir,
                 binary_threshold=args.threshold,
+                predictor=predictor,
+                # only written if something reads it, extracting features
+                # costs time in every test
+                log_file=(
+                    observation_file
+                    if any(x is not None for x in (predictor, metrics, preamble))
+                    else None
+                ),
+                preamble=preamble,
             ),
             outdir=iteration_dir,
             timeout=args.timeout,
+            pass_group_file=pass_group_file,
+            pass_timeout=args.pass_timeout,
+        )
+        logging.info(
+            f"Step {i+1}: reduction took {result.time:.1f}s with {result.tests} tests"
+            + (" (timeout)" if result.timed_out else "")
         )
+        if result.program is not None:
+            p = result.program
 
         step_p, step_ratio = get_best_program(tmpdir, setting)
         if step_ratio > best_ratio:
             p = step_p
 
-        if get_ratio(p, setting) - best_ratio < args.min_improvement_per_round:
+        step_improvement = get_ratio(p, setting, preamble) - best_ratio
+        if step_improvement < args.min_improvement_per_round:
             rounds_no_improvement += 1
         else:
             rounds_no_improvement = 0
 
         with open(iteration_dir / "best.c", "w") as f:
             f.write(p.code)
+        if archive is not None:
+            archive.add(p, setting)
         # shutil.rmtree(tmpdir)
 
+        if preamble is not None:
+            log_pch_hit_rate(observation_file, i + 1)
+        if predictor is not None:
+            log_predictor_report(experiment_root, predictor, observation_file, i + 1)
+            predictor = fit_predictor(
+                args, args.predictor_data + [seed_file, observation_file]
+            )
+
+    if metrics is not None:
+        metrics.set(
+            "best_ratio",
+            get_ratio(p, setting),
+            compiler=args.compiler,
+            opt_level=args.opt_level,
+        )
+        reporter.stop()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--rounds", type=int, required=True)
     parser.add_argument("--initial-programs", type=int, default=10)
+    parser.add_argument(
+        "--seed-time-budget",
+        type=float,
+        help="Search initial programs for this many seconds instead of "
+        "generating --initial-programs",
+    )
+    parser.add_argument(
+        "--seed-cpu-budget", type=float, help="Like --seed-time-budget in CPU seconds"
+    )
+    parser.add_argument(
+        "--seed-patience",
+        type=int,
+        help="Stop the seed search if the best ratio did not improve for this many programs",
+    )
+    parser.add_argument(
+        "--seed-top-k", type=int, default=10, help="Programs kept by the seed search"
+    )
+    parser.add_argument(
+        "--seed-size-slack",
+        type=float,
+        default=2.0,
+        help="Heuristic of the seed search: once --seed-top-k programs are kept, skip "
+        "compiling programs whose ratio could not beat them even with a binary this many "
+        "times the largest one seen so far. Can drop good programs, 0 disables it",
+    )
     parser.add_argument(
         "--opt-level",
         type=str,
@@ -142,11 +511,128 @@ if __name__ == "__main__":
     )
     parser.add_argument("--compiler", type=str, choices=["gcc", "clang"], default="gcc")
     parser.add_argument("--timeout", type=int, default=300)
+    parser.add_argument(
+        "--reducer",
+        type=str,
+        default="creduce",
+        help="creduce or cvise binary used for the reduction",
+    )
+    parser.add_argument("--jobs", type=int, help="Number of parallel reducer jobs")
+    parser.add_argument(
+        "--test-timeout", type=int, help="Timeout of a single interestingness test"
+    )
+    parser.add_argument(
+        "--pass-group-file", type=str, help="cvise pass group JSON to reduce with"
+    )
+    parser.add_argument(
+        "--fast-passes",
+        action="store_true",
+        help="Reduce with the profiled fast cvise passes (pass_data/fast_maybe_useful.json)",
+    )
+    parser.add_argument(
+        "--pass-timeout",
+        type=float,
+        help="Run every pass of the pass group separately with this timeout",
+    )
     parser.add_argument("--out", type=str, default="out")
     parser.add_argument("--threshold", type=int, default=100)
     parser.add_argument("--max-rounds-no-improvement", type=int, default=3)
     parser.add_argument("--min-improvement-per-round", type=float, default=0.2)
     parser.add_argument("--csmith-include-path", type=str)
+    parser.add_argument(
+        "--csmith-profile",
+        type=str,
+        help="CSmith option profile stored by csmith_tuning.py",
+    )
+    parser.add_argument(
+        "--pch",
+        action="store_true",
+        help="Experimental: compile candidates against a precompiled CSmith "
+        "preamble. Only candidates that still start with the complete preamble use "
+        "it, which is rarely the case after the first round, and no speedup has been "
+        "measured on real CSmith seeds. The hit rate and compile times are logged "
+        "per round",
+    )
+    parser.add_argument(
+        "--predictor",
+        action="store_true",
+        help="Pre-screen candidates with a learned ratio predictor",
+    )
+    parser.add_argument(
+        "--predictor-data",
+        type=str,
+        nargs="*",
+        default=[],
+        help="observations.jsonl files of earlier runs to train the predictor on",
+    )
+    parser.add_argument("--predictor-confidence", type=float, default=3.0)
+    parser.add_argument("--predictor-min-samples", type=int, default=50)
+    parser.add_argument("--predictor-audit-rate", type=float, default=0.05)
+    parser.add_argument(
+        "--archive",
+        type=str,
+        help="Directory of the elite archive shared between runs",
+    )
+    parser.add_argument("--archive-top-k", type=int, default=20)
+    parser.add_argument(
+        "--archive-import",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Earlier experiment folders whose step_N/best.c are added to the archive",
+    )
+    parser.add_argument(
+        "--seed-from-archive",
+        type=int,
+        default=0,
+        help="Number of archived elites to add to the initial pool (requires --archive)",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        type=str,
+        help="Write live metrics in Prometheus text format to this file",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve live metrics on localhost:PORT/metrics"
+    )
+    parser.add_argument("--metrics-interval", type=float, default=10)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Run as coordinator and distribute the work to this many workers "
+        "(start them with distributed.py)",
+    )
+    parser.add_argument(
+        "--coordinator-host",
+        type=str,
+        default="localhost",
+        help="Interface the coordinator listens on, other than localhost requires "
+        "--coordinator-token",
+    )
+    parser.add_argument("--coordinator-port", type=int, default=5555)
+    parser.add_argument(
+        "--coordinator-token",
+        type=str,
+        default=os.environ.get("AST_COORDINATOR_TOKEN"),
+        help="Shared secret workers must send (distributed.py --token), "
+        "defaults to $AST_COORDINATOR_TOKEN",
+    )
 
     args = parser.parse_args()
+    # fail before generating seeds and creating the experiment folder
+    if (args.seed_from_archive or args.archive_import) and not args.archive:
+        parser.error("--seed-from-archive and --archive-import require --archive")
+    if (
+        args.workers
+        and not args.coordinator_token
+        and not is_loopback(args.coordinator_host)
+    ):
+        parser.error("--coordinator-host other than localhost requires a token")
+    if (args.pass_group_file or args.fast_passes) and not Path(
+        args.reducer
+    ).name.startswith("cvise"):
+        parser.error("--pass-group-file and --fast-passes require --reducer cvise")
+    if args.pass_timeout is not None and not (args.pass_group_file or args.fast_passes):
+        parser.error("--pass-timeout requires --pass-group-file or --fast-passes")
     main(args)
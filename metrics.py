@@ -0,0 +1,271 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import psutil
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {cumulative}")
+        return lines
+
+
+class Metrics:
+    """Minimal registry of gauges, counters and histograms in Prometheus format"""
+
+    def __init__(self, prefix: str = "ast") -> None:
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.types: dict[str, str] = {}
+        self.helps: dict[str, str] = {}
+        self.values: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def declare(self, name: str, kind: str, help: str):
+        self.types[name] = kind
+        self.helps[name] = help
+        if kind == "histogram":
+            self.histograms[name] = Histogram()
+        else:
+            self.values[name] = {}
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def get(self, name: str, **labels) -> float:
+        with self.lock:
+            return self.values[name].get(tuple(sorted(labels.items())), 0)
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, kind in self.types.items():
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full_name} {self.helps[name]}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                if kind == "histogram":
+                    lines += self.histograms[name].render(full_name)
+                    continue
+                for labels, value in self.values[name].items():
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str | Path):
+        """Atomically write the metrics, e.g. for the node_exporter textfile collector"""
+        tmp_file = Path(f"{path}.tmp")
+        with open(tmp_file, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_file, path)
+
+    def serve(self, port: int, host: str = "localhost") -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+def experiment_metrics() -> Metrics:
+    metrics = Metrics()
+    metrics.declare("best_ratio", "gauge", "Best binary to source ratio per setting")
+    metrics.declare("round", "gauge", "Current reduction round")
+    metrics.declare("tests_total", "counter", "Interestingness tests run")
+    metrics.declare("tests_accepted_total", "counter", "Interestingness tests accepted")
+    metrics.declare("tests_per_second", "gauge", "Interestingness tests per second")
+    metrics.declare(
+        "accept_rate", "gauge", "Fraction of accepted interestingness tests"
+    )
+    metrics.declare(
+        "prescreen_hits_total",
+        "counter",
+        "Tests answered by the ratio predictor without compiling",
+    )
+    metrics.declare(
+        "prescreen_hit_rate", "gauge", "Fraction of tests answered by the predictor"
+    )
+    metrics.declare("pch_candidates_total", "counter", "Compiles with --pch")
+    metrics.declare(
+        "pch_compiles_total", "counter", "Compiles against the precompiled preamble"
+    )
+    metrics.declare(
+        "pch_hit_rate",
+        "gauge",
+        "Fraction of --pch compiles that used the precompiled preamble",
+    )
+    metrics.declare("sanitize_seconds", "histogram", "Sanitizer latency")
+    metrics.declare("compile_seconds", "histogram", "Compile latency")
+    metrics.declare("reducer_jobs_busy", "gauge", "Running interestingness tests")
+    metrics.declare(
+        "reducer_utilization", "gauge", "Running interestingness tests per job"
+    )
+    return metrics
+
+
+class MetricsReporter:
+    """Updates `metrics` from the observation log written by the tests.
+
+    The interestingness tests run in processes started by creduce, so they
+    report through the jsonl log (see `predictor.record_observation`) which is
+    followed here in a background thread.
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        log_file: str | Path,
+        jobs: int,
+        textfile: str | Path | None = None,
+        interval: float = 10,
+    ) -> None:
+        self.metrics = metrics
+        self.log_file = Path(log_file)
+        self.jobs = jobs
+        self.textfile = textfile
+        self.interval = interval
+        self.offset = 0
+        self.last_update = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.stop()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.update()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.update()
+            except Exception:
+                logging.exception("Failed to update metrics")
+
+    def read_new_records(self) -> list[dict]:
+        if not self.log_file.exists():
+            return []
+        records = []
+        with open(self.log_file, "r") as f:
+            f.seek(self.offset)
+            for line in f:
+                # keep partially written lines for the next update
+                if not line.endswith("\n"):
+                    break
+                self.offset += len(line.encode())
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    def update(self):
+        m = self.metrics
+        records = self.read_new_records()
+        for r in records:
+            m.inc("tests_total")
+            if r["accepted"]:
+                m.inc("tests_accepted_total")
+            if r.get("prescreen") == "reject":
+                m.inc("prescreen_hits_total")
+            if r.get("pch") is not None:
+                m.inc("pch_candidates_total")
+                if r["pch"]:
+                    m.inc("pch_compiles_total")
+            if r.get("sanitize_time") is not None:
+                m.observe("sanitize_seconds", r["sanitize_time"])
+            if r.get("compile_time") is not None:
+                m.observe("compile_seconds", r["compile_time"])
+
+        now = time.monotonic()
+        m.set("tests_per_second", len(records) / max(now - self.last_update, 1e-6))
+        self.last_update = now
+        total = m.get("tests_total")
+        if total:
+            m.set("accept_rate", m.get("tests_accepted_total") / total)
+            m.set("prescreen_hit_rate", m.get("prescreen_hits_total") / total)
+        if m.get("pch_candidates_total"):
+            m.set(
+                "pch_hit_rate",
+                m.get("pch_compiles_total") / m.get("pch_candidates_total"),
+            )
+
+        busy = count_running_tests()
+        m.set("reducer_jobs_busy", busy)
+        m.set("reducer_utilization", busy / self.jobs)
+
+        if self.textfile is not None:
+            m.write_textfile(self.textfile)
+
+
+def count_running_tests() -> int:
+    """Number of interestingness scripts running below this process"""
+    busy = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if any(arg.endswith("check.py") for arg in child.cmdline()):
+                busy += 1
+        except psutil.Error:
+            continue
+    return busy
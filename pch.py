@@ -0,0 +1,119 @@
+import logging
+import subprocess
+import tempfile
+from functools import cached_property
+from pathlib import Path
+
+from diopter.compiler import (
+    CompilationSetting,
+    CompilerProject,
+    Language,
+    ObjectCompilationOutput,
+    SourceProgram,
+)
+from diopter.generator import find_csmith_include_path
+from diopter.utils import run_cmd
+
+from utils import compilation_cmd
+
+
+class PrecompiledPreamble:
+    """Precompiled header for the CSmith runtime preamble of a setting.
+
+    Preprocessed CSmith programs start with the expanded `csmith.h`. Programs
+    that still start with exactly this text are compiled as body only against a
+    precompiled header (gcc `.gch`, clang `.pch`) built once per setting. All
+    other programs, e.g., once creduce removed parts of the preamble, are
+    compiled in full as before.
+
+    Removing unused preamble code is the cheapest way for creduce to raise the
+    ratio, so after the first round few candidates still match. The saving
+    per matching compile grows with the size of the preamble and is small for
+    headers of about a thousand functions. Whether a test used the header and
+    its compile time are recorded in the observation log, see
+    `log_pch_hit_rate` in main.py.
+    """
+
+    def __init__(
+        self, preamble: str, setting: CompilationSetting, directory: str | Path
+    ):
+        self.setting = setting
+        self.header = Path(directory).absolute() / "preamble.h"
+        self.header.parent.mkdir(parents=True, exist_ok=True)
+        self.header.write_text(preamble)
+        self.build()
+
+    @classmethod
+    def from_csmith(
+        cls,
+        setting: CompilationSetting,
+        directory: str | Path,
+        include_path: str | None = None,
+    ) -> "PrecompiledPreamble":
+        """Preamble of programs preprocessed with `make_compiler_agnostic=True`"""
+        program = SourceProgram(
+            code='#include "csmith.h"\n',
+            language=Language.C,
+            system_include_paths=(
+                include_path if include_path else find_csmith_include_path(),
+            ),
+        )
+        preamble = setting.preprocess_program(program, make_compiler_agnostic=True)
+        return cls(preamble.code, setting, directory)
+
+    @property
+    def is_clang(self) -> bool:
+        return self.setting.compiler.project == CompilerProject.LLVM
+
+    @property
+    def pch(self) -> Path:
+        return self.header.with_name(
+            self.header.name + (".pch" if self.is_clang else ".gch")
+        )
+
+    @cached_property
+    def preamble(self) -> str:
+        return self.header.read_text()
+
+    def build(self):
+        run_cmd(
+            compilation_cmd(self.setting, ("-xc-header",))
+            + [str(self.header), "-o", str(self.pch)]
+        )
+        logging.info(f"Built precompiled preamble {self.pch}")
+
+    def split(self, program: SourceProgram) -> str | None:
+        """The program without the preamble, None if it does not start with it"""
+        if program.flags or not program.code.startswith(self.preamble):
+            return None
+        return program.code[len(self.preamble) :]
+
+    def get_binary_size(self, program: SourceProgram) -> int | None:
+        """.text size of `program` compiled against the precompiled preamble.
+
+        Returns:
+            (int | None):
+                The size or None if the program does not start with the preamble.
+        """
+        body = self.split(program)
+        if body is None:
+            return None
+
+        include = (
+            ["-include-pch", str(self.pch)]
+            if self.is_clang
+            else ["-include", str(self.header), "-Winvalid-pch"]
+        )
+        output = ObjectCompilationOutput(None)
+        with tempfile.NamedTemporaryFile("w", suffix=".c") as body_file:
+            body_file.write(body)
+            body_file.flush()
+            try:
+                run_cmd(
+                    compilation_cmd(self.setting, ("-xc",), tuple(include))
+                    + [body_file.name, "-c", "-o", str(output.filename)]
+                )
+            except subprocess.CalledProcessError:
+                # e.g. the body redefines something of the preamble
+                return None
+        return output.text_size()
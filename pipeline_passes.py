@@ -6,9 +6,17 @@ from diopter.compiler import SourceProgram
 from diopter.sanitizer import Sanitizer
 from static_globals.instrumenter import annotate_with_static
 
-from utils_passes import ReduceRatio, ReducerWithArgs, get_ratio, read_sourcefile, get_standard_compiler_settings, write_pass_file
+from utils_passes import (
+    ReduceRatio,
+    ReducerWithArgs,
+    get_ratio,
+    read_sourcefile,
+    get_standard_compiler_settings,
+    write_pass_file,
+    write_fast_pass_file,
+)
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     # #programs to consider to find an interesting start program
     nstartp = 1
     # #rounds to recursively search for better ratios
@@ -33,44 +41,38 @@ if __name__ == '__main__':
         default_options = json.load(f)
     with open(slow_useful_file) as f:
         slow_useful = json.load(f)
-    with open(fast_maybe_useful_file) as f:
-        fast_maybe_useful = json.load(f)
 
     # create fast_options first, will always stay the same
-    fast_options = []
-    # take order of default options for fast ones -> to be faster
-    for option in default_options["first"]:
-        if option in fast_maybe_useful:
-            fast_options.append(option)
-    # add all other options (skip all non-last things)
-    for option in fast_maybe_useful:
-        if (option not in fast_options) and (option not in default_options["last"]):
-            fast_options.append(option)
-    
+    write_fast_pass_file(
+        fast_options_pass_file, default_options_file, fast_maybe_useful_file
+    )
+
     # try out lines - 0 just for funs
     write_pass_file(lines_0_pass_file, first=[{"pass": "lines", "arg": "0"}])
 
-    write_pass_file(fast_options_pass_file, first=fast_options)
-
     cs = get_standard_compiler_settings()
     # change to [-10:]
     for filenr, file in enumerate(os.listdir("bigbinaries")[-5:], 5):
-    #for filenr, file in enumerate(["program95.c"]):
+        # for filenr, file in enumerate(["program95.c"]):
         sanitizer = Sanitizer()  # bool checks all possible failures
         code = read_sourcefile(f"bigbinaries/{file}")
         queue = [code]
-        print("start with program " f"bigbinaries/{file} into file results_{filenr}_xx.c")
+        print(
+            "start with program " f"bigbinaries/{file} into file results_{filenr}_xx.c"
+        )
         for round in range(nrounds):
             p: SourceProgram = max(queue, key=lambda x: get_ratio(x, cs))
             queue = []
             p = annotate_with_static(p)
             ratio = get_ratio(p, cs)
             interestingness = ReduceRatio(sanitizer, cs, ratio)
-            p = ReducerWithArgs(fast_options_pass_file, cvise_bin).reduce(p, interestingness)
+            p = ReducerWithArgs(fast_options_pass_file, cvise_bin).reduce(
+                p, interestingness
+            )
             # apply fast options first
             ratio = get_ratio(p, cs)
 
-            interestingness = ReduceRatio(sanitizer, cs, ratio)            
+            interestingness = ReduceRatio(sanitizer, cs, ratio)
             p = ReducerWithArgs(lines_0_pass_file, cvise_bin).reduce(p, interestingness)
             ratio = get_ratio(p, cs)
             interestingness = ReduceRatio(sanitizer, cs, ratio)
@@ -84,10 +86,12 @@ if __name__ == '__main__':
                 pas = random.choice(slow_useful)
                 write_pass_file(slow_useful_pass_file, first=[pas])
                 # apply single slow pass and pray it does not take that long
-                newp = ReducerWithArgs(slow_useful_pass_file, cvise_bin).reduce(p, interestingness)
+                newp = ReducerWithArgs(slow_useful_pass_file, cvise_bin).reduce(
+                    p, interestingness
+                )
                 assert newp
                 queue.append(newp)
-    
+
     p: SourceProgram = max(queue, key=lambda x: get_ratio(x, cs))
     ratio = get_ratio(p, cs)
     interestingness = ReduceRatio(sanitizer, cs, ratio)
@@ -0,0 +1,248 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+from pathlib import Path
+
+from diopter.compiler import SourceProgram
+
+FEATURE_NAMES = [
+    "tokens",
+    "loops",
+    "arrays",
+    "structs",
+    "functions",
+    "calls",
+    "expression_depth",
+    "brace_depth",
+]
+
+TOKEN_RE = re.compile(r"[A-Za-z_]\w*|\d+|\S")
+LOOP_RE = re.compile(r"\b(for|while|do)\b")
+STRUCT_RE = re.compile(r"\b(struct|union)\b")
+CALL_RE = re.compile(r"\b([A-Za-z_]\w*)\s*\(")
+FUNCTION_RE = re.compile(r"^[A-Za-z_][\w\s\*]*\b[A-Za-z_]\w*\s*\([^;{}]*\)\s*\{", re.M)
+KEYWORDS = {"if", "for", "while", "do", "switch", "return", "sizeof"}
+
+
+def max_nesting(code: str, open_char: str, close_char: str) -> int:
+    depth = 0
+    max_depth = 0
+    for c in code:
+        if c == open_char:
+            depth += 1
+            max_depth = max(max_depth, depth)
+        elif c == close_char:
+            depth = max(depth - 1, 0)
+    return max_depth
+
+
+def extract_features(code: str) -> list[float]:
+    """Cheap syntactic features of a C program, one entry per FEATURE_NAMES"""
+    calls = [name for name in CALL_RE.findall(code) if name not in KEYWORDS]
+    return [
+        len(TOKEN_RE.findall(code)),
+        len(LOOP_RE.findall(code)),
+        code.count("["),
+        len(STRUCT_RE.findall(code)),
+        len(FUNCTION_RE.findall(code)),
+        len(calls),
+        max_nesting(code, "(", ")"),
+        max_nesting(code, "{", "}"),
+    ]
+
+
+def solve(a: list[list[float]], b: list[float]) -> list[float]:
+    """Solve the linear system a x = b with gaussian elimination"""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            continue
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= factor * m[col][c]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+def load_observations(*paths) -> list[dict]:
+    observations = []
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    observations.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # lines can be cut off if a test was killed while writing
+                    continue
+    return observations
+
+
+def record_observation(
+    log_file: str | Path,
+    features: list[float],
+    ratio: float | None,
+    target: float,
+    accepted: bool,
+    predicted: float | None = None,
+    prescreen: str | None = None,
+    sanitize_time: float | None = None,
+    compile_time: float | None = None,
+    pch: bool | None = None,
+):
+    """Append a single compile result to a jsonl log.
+
+    The log is written to concurrently by the creduce jobs, so every record is
+    emitted with a single append-only write.
+    """
+    record = {
+        "features": features,
+        "ratio": ratio,
+        "target": target,
+        "accepted": accepted,
+        "predicted": predicted,
+        "prescreen": prescreen,
+        "sanitize_time": sanitize_time,
+        "compile_time": compile_time,
+        "pch": pch,
+    }
+    line = (json.dumps(record) + "\n").encode()
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o660)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class RatioPredictor:
+    """Ridge regression surrogate for the binary-to-source ratio of a program.
+
+    The predictor is only used to skip candidates: a candidate is rejected if the
+    upper confidence bound `prediction + confidence * residual_std` is still below
+    the target ratio. A fraction of the rejected candidates (`audit_rate`) is
+    compiled anyway, which allows measuring the false-reject rate.
+    """
+
+    def __init__(
+        self,
+        confidence: float = 3.0,
+        min_samples: int = 50,
+        audit_rate: float = 0.05,
+        regularization: float = 1.0,
+    ) -> None:
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.audit_rate = audit_rate
+        self.regularization = regularization
+        self.weights: list[float] | None = None
+        self.residual_std = 0.0
+        self.n_samples = 0
+
+    @staticmethod
+    def transform(features: list[float]) -> list[float]:
+        return [1.0] + [math.log1p(f) for f in features]
+
+    @property
+    def ready(self) -> bool:
+        return self.weights is not None and self.n_samples >= self.min_samples
+
+    def fit(self, observations: list[dict]) -> "RatioPredictor":
+        observations = [o for o in observations if o.get("ratio") is not None]
+        xs = [self.transform(o["features"]) for o in observations]
+        ys = [o["ratio"] for o in observations]
+        self.n_samples = len(xs)
+        if self.n_samples < self.min_samples:
+            logging.info(
+                f"Not enough observations to fit predictor ({self.n_samples}/{self.min_samples})"
+            )
+            return self
+
+        dim = len(xs[0])
+        xtx = [[0.0] * dim for _ in range(dim)]
+        xty = [0.0] * dim
+        for x, y in zip(xs, ys):
+            for i in range(dim):
+                xty[i] += x[i] * y
+                for j in range(dim):
+                    xtx[i][j] += x[i] * x[j]
+        # do not regularize the bias term
+        for i in range(1, dim):
+            xtx[i][i] += self.regularization
+        self.weights = solve(xtx, xty)
+
+        residuals = [y - self._predict(x) for x, y in zip(xs, ys)]
+        self.residual_std = math.sqrt(sum(r * r for r in residuals) / len(residuals))
+        return self
+
+    def _predict(self, x: list[float]) -> float:
+        return sum(w * v for w, v in zip(self.weights, x))
+
+    def predict_features(self, features: list[float]) -> float | None:
+        if not self.ready:
+            return None
+        return self._predict(self.transform(features))
+
+    def predict(self, program: SourceProgram) -> float | None:
+        return self.predict_features(extract_features(program.code))
+
+    def upper_bound(self, predicted: float) -> float:
+        return predicted + self.confidence * self.residual_std
+
+    def prescreen(
+        self, features: list[float], target: float
+    ) -> tuple[float | None, str]:
+        """Decide whether a candidate must be compiled.
+
+        Returns:
+            (float | None, str):
+                The predicted ratio and one of "pass", "reject" or "audit".
+                Candidates marked "reject" do not need to be compiled.
+        """
+        predicted = self.predict_features(features)
+        if predicted is None or self.upper_bound(predicted) >= target:
+            return predicted, "pass"
+        if random.random() < self.audit_rate:
+            return predicted, "audit"
+        return predicted, "reject"
+
+    def report(self, observations: list[dict]) -> dict:
+        """Calibration and false-reject statistics on the given observations"""
+        scored = [
+            o
+            for o in observations
+            if o.get("predicted") is not None and o.get("ratio") is not None
+        ]
+        audited = [o for o in scored if o.get("prescreen") == "audit"]
+        rejected = [o for o in observations if o.get("prescreen") == "reject"]
+        covered = [o for o in scored if o["ratio"] <= self.upper_bound(o["predicted"])]
+        false_rejects = [o for o in audited if o["accepted"]]
+        return {
+            "samples": len(scored),
+            "mean_abs_error": (
+                sum(abs(o["ratio"] - o["predicted"]) for o in scored) / len(scored)
+                if scored
+                else None
+            ),
+            "upper_bound_coverage": len(covered) / len(scored) if scored else None,
+            "skipped_compiles": len(rejected),
+            "audited": len(audited),
+            "false_reject_rate": len(false_rejects) / len(audited) if audited else None,
+        }
+
+    def to_dict(self) -> dict:
+        """State of the fitted predictor, e.g. to send it to a worker"""
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "RatioPredictor":
+        predictor = cls()
+        vars(predictor).update(state)
+        return predictor
@@ -1,18 +1,25 @@
+import asyncio
+import json
 import logging
 import os
 import shutil
+import signal
 import subprocess
 import tempfile
+import time
 import uuid
-from dataclasses import replace
+from dataclasses import dataclass, replace
 from multiprocessing import cpu_count
 from pathlib import Path
+from typing import TextIO
 
 from diopter.compiler import CompilationSetting, ProgramType, SourceProgram
 from diopter.reducer import ReductionCallback, make_interestingness_script
 from diopter.sanitizer import Sanitizer
 from static_globals.instrumenter import annotate_with_static
 
+from pch import PrecompiledPreamble
+from predictor import RatioPredictor, extract_features, record_observation
 from utils import get_binary_size
 
 
@@ -25,11 +32,17 @@ class ReduceBinaryRatio(ReductionCallback):
         tmpdir: str = None,
         save_temps=False,
         binary_threshold=100,
+        predictor: RatioPredictor | None = None,
+        log_file: str | None = None,
+        preamble: PrecompiledPreamble | None = None,
     ) -> None:
         self.san = san
         self.ratio = ratio
         self.setting = setting
         self.binary_threshold = binary_threshold
+        self.predictor = predictor
+        self.log_file = Path(log_file).absolute() if log_file else None
+        self.preamble = preamble
 
         if save_temps and tmpdir is None:
             raise AttributeError("tmpdir must be given if save_temps=True")
@@ -37,16 +50,68 @@ class ReduceBinaryRatio(ReductionCallback):
         self.save_temps = save_temps
 
     def test(self, program: SourceProgram) -> bool:
-        if not self.san.sanitize(program):
+        features = None
+        if self.predictor or self.log_file:
+            features = extract_features(program.code)
+        predicted, prescreen = None, None
+        if self.predictor:
+            predicted, prescreen = self.predictor.prescreen(features, self.ratio)
+            if prescreen == "reject":
+                if self.log_file:
+                    record_observation(
+                        self.log_file,
+                        features,
+                        None,
+                        self.ratio,
+                        False,
+                        predicted,
+                        prescreen,
+                    )
+                return False
+
+        start = time.monotonic()
+        sanitized = self.san.sanitize(program)
+        sanitize_time = time.monotonic() - start
+        if not sanitized:
+            if self.log_file:
+                record_observation(
+                    self.log_file,
+                    features,
+                    None,
+                    self.ratio,
+                    False,
+                    predicted,
+                    prescreen,
+                    sanitize_time=sanitize_time,
+                )
             return False
 
         program = annotate_with_static(program)
 
-        binary_size = get_binary_size(program, self.setting)
-        if (
-            binary_size < self.binary_threshold
-            or binary_size / len(program.code) < self.ratio
-        ):
+        start = time.monotonic()
+        binary_size = None
+        if self.preamble is not None:
+            binary_size = self.preamble.get_binary_size(program)
+        used_pch = binary_size is not None
+        if binary_size is None:
+            binary_size = get_binary_size(program, self.setting)
+        compile_time = time.monotonic() - start
+        ratio = binary_size / len(program.code)
+        accepted = binary_size >= self.binary_threshold and ratio >= self.ratio
+        if self.log_file:
+            record_observation(
+                self.log_file,
+                features,
+                ratio,
+                self.ratio,
+                accepted,
+                predicted,
+                prescreen,
+                sanitize_time=sanitize_time,
+                compile_time=compile_time,
+                pch=used_pch if self.preamble is not None else None,
+            )
+        if not accepted:
             return False
 
         if self.save_temps:
@@ -56,10 +121,43 @@ class ReduceBinaryRatio(ReductionCallback):
         return True
 
 
+@dataclass
+class ReductionResult:
+    program: ProgramType | None
+    time: float
+    timed_out: bool
+    tests: int
+
+
 class CreduceReducer:
-    def __init__(self, creduce: str | None = None):
+    """Runs creduce or cvise on a program.
+
+    Pass group files (`--pass-group-file`) are only supported by cvise.
+    """
+
+    def __init__(
+        self,
+        creduce: str | None = None,
+        jobs: int | None = None,
+        test_timeout: int | None = None,
+    ):
+        """
+        Args:
+            creduce (str | None):
+                path to the creduce or cvise binary, if empty "creduce" will be used
+            jobs (int | None):
+                default number of parallel jobs, if empty cpu_count() will be used
+            test_timeout (int | None):
+                timeout of a single interestingness test in seconds
+        """
         self.creduce = creduce if creduce else "creduce"
         assert shutil.which(self.creduce), f"{self.creduce} is not executable"
+        self.jobs = jobs
+        self.test_timeout = test_timeout
+
+    @property
+    def is_cvise(self) -> bool:
+        return Path(self.creduce).name.startswith("cvise")
 
     def reduce(
         self,
@@ -68,53 +166,287 @@ class CreduceReducer:
         jobs: int | None = None,
         outdir=None,
         timeout=200,
+        pass_group_file: str | None = None,
+        pass_timeout: float | None = None,
+        log_file: TextIO | None = None,
+        debug: bool = False,
     ) -> ProgramType | None:
-        creduce_jobs = jobs if jobs else cpu_count()
+        """Reduce `program` and return the reduced program, see `run`"""
+        return self.run(
+            program,
+            interestingness_test,
+            jobs=jobs,
+            outdir=outdir,
+            timeout=timeout,
+            pass_group_file=pass_group_file,
+            pass_timeout=pass_timeout,
+            log_file=log_file,
+            debug=debug,
+        ).program
 
-        code_filename = "code" + program.language.to_suffix()
-        interestingness_script = make_interestingness_script(
-            interestingness_test, program, code_filename
+    async def reduce_async(
+        self,
+        program: ProgramType,
+        interestingness_test: ReductionCallback,
+        jobs: int | None = None,
+        outdir=None,
+        timeout=200,
+        pass_group_file: str | None = None,
+        pass_timeout: float | None = None,
+        log_file: TextIO | None = None,
+        debug: bool = False,
+    ) -> ProgramType | None:
+        """Asynchronous version of `reduce`"""
+        result = await self.run_async(
+            program,
+            interestingness_test,
+            jobs=jobs,
+            outdir=outdir,
+            timeout=timeout,
+            pass_group_file=pass_group_file,
+            pass_timeout=pass_timeout,
+            log_file=log_file,
+            debug=debug,
         )
+        return result.program
 
-        old_dir = Path(os.getcwd()).absolute()
-        outdir = Path(outdir)
-        os.chdir(outdir)
-
-        code_file = outdir / code_filename
-        with open(code_file, "w") as f:
-            f.write(program.code)
-
-        script_path = outdir / "check.py"
-        with open(script_path, "w") as f:
-            print(interestingness_script, file=f)
-        os.chmod(script_path, 0o770)
-        # run creduce
-        creduce_cmd = [
-            self.creduce,
-            "--n",
-            f"{creduce_jobs}",
-            str(script_path.name),
-            str(code_file.name),
-        ]
+    def run(
+        self,
+        program: ProgramType,
+        interestingness_test: ReductionCallback,
+        jobs: int | None = None,
+        outdir=None,
+        timeout: float | None = 200,
+        pass_group_file: str | None = None,
+        pass_timeout: float | None = None,
+        log_file: TextIO | None = None,
+        debug: bool = False,
+    ) -> ReductionResult:
+        """Reduce `program`, see `run_async`.
 
-        try:
-            tmpdir = Path(tempfile.mkdtemp())
-            env = os.environ.copy()
-            env.update({"TMPDIR": str(tmpdir.absolute())})
+        Must not be called from a running event loop, use `run_async` there.
+        """
+        return asyncio.run(
+            self.run_async(
+                program,
+                interestingness_test,
+                jobs=jobs,
+                outdir=outdir,
+                timeout=timeout,
+                pass_group_file=pass_group_file,
+                pass_timeout=pass_timeout,
+                log_file=log_file,
+                debug=debug,
+            )
+        )
 
-            subprocess.run(
-                creduce_cmd, cwd=outdir, check=True, timeout=timeout, env=env
+    async def run_async(
+        self,
+        program: ProgramType,
+        interestingness_test: ReductionCallback,
+        jobs: int | None = None,
+        outdir=None,
+        timeout: float | None = 200,
+        pass_group_file: str | None = None,
+        pass_timeout: float | None = None,
+        log_file: TextIO | None = None,
+        debug: bool = False,
+    ) -> ReductionResult:
+        """
+        Reduce `program` according to the `interestingness_test`
+
+        Nothing depends on the working directory of the process, so several
+        reductions can run concurrently. Cancelling the task kills the whole
+        creduce process tree and removes its temporary files.
+
+        Args:
+            program (ProgramType):
+                the program to reduce
+            interestingness_test (ReductionCallback):
+                a concrete ReductionCallback that implementes the interestingness
+            jobs (int | None):
+                the number of creduce jobs, if empty the reducer default is used
+            outdir:
+                where the program and the interestingness script are stored,
+                if empty a temporary directory is used
+            timeout (float | None):
+                wall-clock timeout of the whole reduction in seconds
+            pass_group_file (str | None):
+                cvise pass group JSON to use instead of the default schedule
+            pass_timeout (float | None):
+                if given, every pass of the pass group runs as a separate cvise
+                invocation limited to this many seconds
+            log_file (TextIO | None):
+                where to log creduce's output, if empty it goes to stdout
+            debug (bool):
+                whether to pass the debug flag to creduce
+
+        Returns:
+            (ReductionResult):
+                the reduced program (None if creduce failed), the time used,
+                whether the reduction timed out and the number of tests run.
+        """
+        if pass_group_file is not None and not self.is_cvise:
+            raise ValueError("pass group files are only supported by cvise")
+        if pass_timeout is not None and pass_group_file is None:
+            raise ValueError("pass_timeout requires a pass_group_file")
+
+        creduce_jobs = jobs if jobs else self.jobs if self.jobs else cpu_count()
+
+        with tempfile.TemporaryDirectory() as workdir:
+            outdir = Path(outdir if outdir else workdir).absolute()
+            counter_file = outdir / "tests.count"
+            counter_file.write_bytes(b"")
+
+            code_filename = "code" + program.language.to_suffix()
+            interestingness_script = count_tests(
+                make_interestingness_script(
+                    interestingness_test, program, code_filename
+                ),
+                counter_file,
+            )
+
+            code_file = outdir / code_filename
+            with open(code_file, "w") as f:
+                f.write(program.code)
+
+            script_path = outdir / "check.py"
+            with open(script_path, "w") as f:
+                print(interestingness_script, file=f)
+            os.chmod(script_path, 0o770)
+
+            if pass_timeout is None:
+                schedule = [(pass_group_file, timeout)]
+            else:
+                schedule = [
+                    (group, pass_timeout)
+                    for group in split_pass_group(pass_group_file, outdir)
+                ]
+
+            start_time = time.monotonic()
+            timed_out = False
+            try:
+                for group_file, step_timeout in schedule:
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - start_time)
+                        if remaining <= 0:
+                            timed_out = True
+                            break
+                        step_timeout = min(step_timeout or remaining, remaining)
+
+                    creduce_cmd = [self.creduce, "--n", f"{creduce_jobs}"]
+                    if self.test_timeout is not None:
+                        creduce_cmd += ["--timeout", f"{self.test_timeout}"]
+                    if group_file is not None:
+                        creduce_cmd += ["--pass-group-file", str(group_file)]
+                    if debug:
+                        creduce_cmd.append("--debug")
+                    creduce_cmd += [str(script_path.name), str(code_file.name)]
+
+                    if not await self.run_creduce(
+                        creduce_cmd, outdir, step_timeout, log_file
+                    ):
+                        # a pass running into its pass_timeout does not stop
+                        # the reduction, only the wall-clock timeout does
+                        if step_timeout != pass_timeout:
+                            timed_out = True
+                            break
+            except subprocess.CalledProcessError as e:
+                logging.info(f"Failed to reduce code. Exception: {e}")
+                return ReductionResult(
+                    None,
+                    time.monotonic() - start_time,
+                    False,
+                    len(counter_file.read_bytes()),
+                )
+
+            with open(code_file, "r") as f:
+                reduced_code = f.read()
+
+            return ReductionResult(
+                replace(program, code=reduced_code),
+                time.monotonic() - start_time,
+                timed_out,
+                len(counter_file.read_bytes()),
+            )
+
+    async def run_creduce(
+        self,
+        creduce_cmd: list[str],
+        outdir: Path,
+        timeout: float | None,
+        log_file: TextIO | None,
+    ) -> bool:
+        """Run a single creduce invocation, returns False on timeout"""
+        # creduce likes to kill unfinished processes with SIGKILL
+        # so they can't clean up after themselves.
+        # Setting a temporary directory for creduce to be able to clean
+        # up everything
+        tmpdir = Path(tempfile.mkdtemp())
+        env = os.environ.copy()
+        env.update({"TMPDIR": str(tmpdir.absolute())})
+        try:
+            # own session so the whole process tree can be killed at once
+            process = await asyncio.create_subprocess_exec(
+                *creduce_cmd,
+                cwd=outdir,
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT if log_file else None,
+                start_new_session=True,
             )
-        except subprocess.TimeoutExpired:
-            logging.info("Cancel reduction: Timeout")
-        except subprocess.CalledProcessError as e:
-            logging.info(f"Failed to reduce code. Exception: {e}")
-            return None
+            try:
+                returncode = await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.info("Cancel reduction: Timeout")
+                return False
+            finally:
+                # also reached on cancellation, kill leftover test processes
+                kill_process_group(process.pid)
+                await process.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, creduce_cmd)
         finally:
             shutil.rmtree(tmpdir, ignore_errors=True)
-            os.chdir(old_dir)
+        return True
+
+
+def kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def count_tests(interestingness_script: str, counter_file: Path) -> str:
+    """Make the script append one byte to `counter_file` per invocation"""
+    counter = (
+        "import os as _os\n"
+        f"_fd = _os.open({str(counter_file)!r}, _os.O_WRONLY | _os.O_APPEND | _os.O_CREAT)\n"
+        "_os.write(_fd, b'.')\n"
+        "_os.close(_fd)\n"
+    )
+    if interestingness_script.startswith("#!"):
+        shebang, _, body = interestingness_script.partition("\n")
+        return shebang + "\n" + counter + body
+    return counter + interestingness_script
+
+
+def split_pass_group(pass_group_file: str, outdir: Path) -> list[Path]:
+    """Write one pass group file per pass of `pass_group_file`.
 
-        with open(code_file, "r") as f:
-            reduced_code = f.read()
+    The passes keep their phase ("first", "main" or "last") and their order.
+    """
+    with open(pass_group_file, "r") as f:
+        pass_group = json.load(f)
 
-        return replace(program, code=reduced_code)
+    group_files = []
+    for phase in ("first", "main", "last"):
+        for i, pas in enumerate(pass_group.get(phase, [])):
+            group_file = outdir / f"pass_{phase}_{i}.json"
+            single = {"first": [], "main": [], "last": []}
+            single[phase] = [pas]
+            with open(group_file, "w") as f:
+                json.dump(single, f)
+            group_files.append(group_file)
+    return group_files
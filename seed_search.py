@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import logging
+import time
+
+from diopter.compiler import CompilationSetting, SourceProgram
+from diopter.generator import CSmithGenerator
+
+from csmith_tuning import cpu_seconds, generate_filtered
+from utils import get_binary_size
+
+
+def stream_seed_search(
+    generator: CSmithGenerator,
+    setting: CompilationSetting,
+    top_k: int = 10,
+    time_budget: float | None = None,
+    cpu_budget: float | None = None,
+    patience: int | None = None,
+    binary_size_slack: float | None = 2.0,
+) -> list[tuple[float, SourceProgram]]:
+    """Anytime search for good initial programs.
+
+    Generated programs are scored one by one and only the `top_k` best are
+    kept. Once the heap is full, a program is dropped without compiling it if
+    even `binary_size_slack` times the largest binary seen so far could not
+    give it a ratio better than the worst kept program. The binary size is not
+    known before compiling, so this is a heuristic and can drop a program
+    that would have been kept.
+
+    Args:
+        generator (CSmithGenerator):
+            generator of the programs
+        setting (CompilationSetting):
+            setting the ratio is computed for
+        top_k (int):
+            number of programs to keep
+        time_budget (float | None):
+            stop after this many wall-clock seconds
+        cpu_budget (float | None):
+            stop after this many CPU seconds (including child processes)
+        patience (int | None):
+            stop if the best ratio did not improve for this many programs
+        binary_size_slack (float | None):
+            factor on the largest binary seen used to estimate the best
+            possible ratio, None or 0 compiles every program
+
+    Returns:
+        (list[tuple[float, SourceProgram]]):
+            ratio and program of the best programs found, best first
+    """
+    if time_budget is None and cpu_budget is None and patience is None:
+        raise ValueError("stream_seed_search needs a budget or a patience")
+
+    start_time = time.monotonic()
+    start_cpu = cpu_seconds()
+    heap: list[tuple[float, int, SourceProgram]] = []
+    tiebreak = itertools.count()
+    max_binary_size = 0
+    best_ratio = 0.0
+    since_improvement = 0
+    generated = 0
+    abandoned = 0
+
+    while True:
+        if time_budget is not None and time.monotonic() - start_time >= time_budget:
+            break
+        if cpu_budget is not None and cpu_seconds() - start_cpu >= cpu_budget:
+            break
+        if patience is not None and since_improvement >= patience:
+            break
+
+        p = generate_filtered(generator, setting)
+        if p is None:
+            continue
+        generated += 1
+        since_improvement += 1
+
+        if binary_size_slack and len(heap) == top_k:
+            bound = binary_size_slack * max_binary_size / len(p.code)
+            if bound <= heap[0][0]:
+                abandoned += 1
+                continue
+
+        try:
+            binary_size = get_binary_size(p, setting)
+        except Exception as e:
+            logging.info(f"Failed to compile generated program: {e}")
+            continue
+        max_binary_size = max(max_binary_size, binary_size)
+        ratio = binary_size / len(p.code)
+
+        if ratio > best_ratio:
+            best_ratio = ratio
+            since_improvement = 0
+        if len(heap) < top_k:
+            heapq.heappush(heap, (ratio, next(tiebreak), p))
+        elif ratio > heap[0][0]:
+            heapq.heapreplace(heap, (ratio, next(tiebreak), p))
+
+    logging.info(
+        f"Seed search: {generated} programs, {abandoned} abandoned without compiling, "
+        f"best ratio {best_ratio}"
+    )
+    return [(ratio, p) for ratio, _, p in sorted(heap, reverse=True)]
@@ -0,0 +1,50 @@
+import multiprocessing
+import shutil
+
+import pytest
+from diopter.compiler import Language, SourceProgram
+
+from archive import EliteArchive
+from utils import make_setting
+
+pytestmark = pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+
+
+def program(i: int) -> SourceProgram:
+    return SourceProgram(
+        code=f"int f{i}(int x) {{ return x * {i}; }}", language=Language.C
+    )
+
+
+def test_lower_top_k_keeps_index_consistent(tmp_path):
+    setting = make_setting("gcc", "O0", flags=())
+    for i in range(5):
+        assert EliteArchive(tmp_path, top_k=5).add(program(i), setting, ratio=i + 1)
+
+    archive = EliteArchive(tmp_path, top_k=3)
+    assert not archive.add(program(5), setting, ratio=0.5)
+    assert [p.code for p in archive.elites(setting)] == [
+        program(i).code for i in (4, 3, 2)
+    ]
+    assert len(list(archive.setting_dir(setting).glob("*.c"))) == 3
+
+
+def add_programs(path, start: int):
+    setting = make_setting("gcc", "O0", flags=())
+    archive = EliteArchive(path, top_k=100)
+    for i in range(start, start + 20):
+        archive.add(program(i), setting, ratio=float(i))
+
+
+def test_concurrent_adds(tmp_path):
+    processes = [
+        multiprocessing.Process(target=add_programs, args=(tmp_path, start))
+        for start in (0, 20, 40)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    archive = EliteArchive(tmp_path, top_k=100)
+    assert len(archive.elites(make_setting("gcc", "O0", flags=()))) == 60
@@ -0,0 +1,118 @@
+import shutil
+import threading
+import time
+
+import pytest
+
+from distributed import (
+    Coordinator,
+    CoordinatorError,
+    Worker,
+    send_message,
+    verified_ratio,
+)
+from utils import make_setting
+
+
+def double(payload: dict) -> dict:
+    time.sleep(payload.get("sleep", 0))
+    return {"value": 2 * payload["x"]}
+
+
+HANDLERS = {"double": double}
+
+
+@pytest.fixture
+def coordinator():
+    with Coordinator("localhost", 0, heartbeat_timeout=0.5) as coordinator:
+        yield coordinator
+
+
+def start_worker(coordinator: Coordinator, **kwargs) -> Worker:
+    host, port = coordinator.address
+    worker = Worker(
+        host, port, HANDLERS, heartbeat_interval=0.1, poll_interval=0.05, **kwargs
+    )
+    threading.Thread(target=worker.run, daemon=True).start()
+    return worker
+
+
+def test_map_on_several_workers(coordinator):
+    workers = [start_worker(coordinator) for _ in range(3)]
+    assert coordinator.wait_for_workers(3, timeout=5)
+    assert len({w.worker_id for w in workers}) == 3
+
+    results = coordinator.map("double", [{"x": x, "sleep": 0.05} for x in range(12)])
+    assert results == [{"value": 2 * x} for x in range(12)]
+
+
+def test_heartbeat_keeps_idle_worker(coordinator):
+    start_worker(coordinator)
+    time.sleep(3 * coordinator.heartbeat_timeout)
+    assert coordinator.n_workers == 1
+
+
+def test_requeue_job_of_lost_worker(coordinator):
+    host, port = coordinator.address
+    # takes a job and never sends a heartbeat or a result
+    lost = Worker(host, port, HANDLERS, heartbeat_interval=100)
+    job_id = coordinator.submit("double", {"x": 21})
+    assert lost.send({"type": "get_job"})["job"]["job_id"] == job_id
+
+    start_worker(coordinator)
+    assert coordinator.wait([job_id], timeout=10) == [{"value": 42}]
+    assert coordinator.n_workers == 1
+
+
+def test_wait_fails_without_workers(coordinator):
+    host, port = coordinator.address
+    Worker(host, port, HANDLERS, heartbeat_interval=100)
+    job_id = coordinator.submit("double", {"x": 1})
+    with pytest.raises(RuntimeError):
+        coordinator.wait([job_id], timeout=10)
+    assert not coordinator.jobs and not coordinator.queue
+
+
+def test_wait_timeout(coordinator):
+    start_worker(coordinator)
+    job_id = coordinator.submit("double", {"x": 1, "sleep": 2})
+    with pytest.raises(RuntimeError):
+        coordinator.wait([job_id], timeout=0.2)
+
+
+def test_error_reply(coordinator):
+    host, port = coordinator.address
+    worker = Worker(host, port, HANDLERS)
+    with pytest.raises(CoordinatorError):
+        send_message(host, port, {"type": "unknown", "worker_id": worker.worker_id})
+    with pytest.raises(CoordinatorError):
+        send_message(host, port, {"type": "get_job"})
+    assert worker.send({"type": "heartbeat"}) == {"stop": False}
+
+
+def test_token():
+    with Coordinator("localhost", 0, token="secret") as coordinator:
+        host, port = coordinator.address
+        with pytest.raises(CoordinatorError):
+            Worker(host, port, HANDLERS)
+        with pytest.raises(CoordinatorError):
+            Worker(host, port, HANDLERS, token="wrong")
+        worker = Worker(host, port, HANDLERS, token="secret")
+        assert worker.send({"type": "heartbeat"}) == {"stop": False}
+
+
+def test_token_required_off_loopback():
+    with pytest.raises(ValueError):
+        Coordinator("0.0.0.0", 0)
+
+
+class AcceptAll:
+    def sanitize(self, program):
+        return True
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+def test_verified_ratio_drops_broken_program():
+    setting = make_setting("gcc", "O0", flags=())
+    assert verified_ratio("int f( {", setting, AcceptAll()) is None
+    assert verified_ratio("int f(int x) { return x; }", setting, AcceptAll()) > 0
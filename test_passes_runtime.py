@@ -6,6 +6,7 @@ from time import time
 
 from diopter.compiler import CompilationSetting, CompilerExe, OptLevel
 from diopter.sanitizer import Sanitizer
+from utils import get_ratios
 from utils_passes import ReduceRatio, ReducerWithArgs, get_ratio, read_sourcefile
 
 if __name__ == "__main__":
@@ -44,18 +45,26 @@ if __name__ == "__main__":
     # don't take too big r or it exponentially explodes
     # for bigger selection draw randomly
     # slice as I could not compute everything in one go
-    all_possibilities = islice(enumerate(combinations_with_replacement(unique_options, r=combinations)), 118, None)
-    
+    all_possibilities = islice(
+        enumerate(combinations_with_replacement(unique_options, r=combinations)),
+        118,
+        None,
+    )
+
+    program_files = os.listdir(program_dir)
+    start_programs = [
+        read_sourcefile(os.path.join(program_dir, file)) for file in program_files
+    ]
+    start_ratios = get_ratios(start_programs, cs)
+
     store_options = {"first": [], "main": [], "last": []}
     for i, selection in all_possibilities:
         # with replacing only first -> application only happens once
         store_options["first"] = list(selection)
         with open(os.path.realpath("tempfile.json"), "w") as f:
             json.dump(store_options, f)
-        for file in os.listdir(program_dir):
+        for start_code, start_ratio in zip(start_programs, start_ratios):
             print(i, list(selection))
-            start_code = read_sourcefile(os.path.join(program_dir, file))
-            start_ratio = get_ratio(start_code, cs)
             interestingness = ReduceRatio(sanitizer, cs, start_ratio)
             reducer = ReducerWithArgs(os.path.realpath("tempfile.json"), cvise_bin)
             # create temporary file that avoids infodump
@@ -64,5 +73,7 @@ if __name__ == "__main__":
                 end_code = reducer.reduce(start_code, interestingness, log_file=f)
                 end_time = time()
             with open(result_file, "a") as f:
-                f.write(f'"{list(selection)}",{start_ratio},{get_ratio(end_code, cs)},{end_time-start_time}\n')
+                f.write(
+                    f'"{list(selection)}",{start_ratio},{get_ratio(end_code, cs)},{end_time-start_time}\n'
+                )
     os.remove("tempfile.json")
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+from diopter.compiler import Language, SourceProgram
+from diopter.reducer import ReductionCallback
+
+from reducer import CreduceReducer
+
+# Stands in for cvise: leaves a grandchild behind, runs the interestingness
+# test three times, "reduces" the program and sleeps for $STUB_SLEEP seconds.
+STUB_REDUCER = """#!/bin/sh
+echo "$@" >> "$STUB_LOG/args"
+echo "$TMPDIR" >> "$STUB_LOG/tmpdirs"
+touch "$TMPDIR/leftover"
+sleep 600 &
+echo $! >> "$STUB_LOG/grandchildren"
+eval script=\\${$(($# - 1))}
+eval code=\\${$#}
+for i in 1 2 3; do ./"$script" || true; done
+echo "int x;" > "$code"
+sleep "${STUB_SLEEP:-0}"
+"""
+
+
+class AlwaysInteresting(ReductionCallback):
+    def test(self, program: SourceProgram) -> bool:
+        return True
+
+
+@pytest.fixture
+def stub_log(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    stub = bin_dir / "cvise"
+    stub.write_text(STUB_REDUCER)
+    stub.chmod(0o755)
+    log = tmp_path / "log"
+    log.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_LOG", str(log))
+    return log
+
+
+def program() -> SourceProgram:
+    return SourceProgram(code="int main() { return 0; }", language=Language.C)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # zombies are dead, they only wait to be reaped
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def lines(path: Path) -> list[str]:
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def assert_cleaned_up(log: Path):
+    time.sleep(0.2)
+    assert lines(log / "grandchildren")
+    for pid in lines(log / "grandchildren"):
+        assert not is_running(int(pid))
+    for tmpdir in lines(log / "tmpdirs"):
+        assert not Path(tmpdir).exists()
+
+
+def test_reduce_counts_tests(stub_log, tmp_path):
+    result = CreduceReducer("cvise", jobs=2).run(
+        program(), AlwaysInteresting(), outdir=tmp_path, timeout=60
+    )
+    assert result.program.code == "int x;\n"
+    assert result.tests == 3
+    assert not result.timed_out
+    assert lines(stub_log / "args")[0].startswith("--n 2 ")
+    assert_cleaned_up(stub_log)
+
+
+def test_timeout_kills_process_tree(stub_log, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "600")
+    start = time.monotonic()
+    result = CreduceReducer("cvise").run(
+        program(), AlwaysInteresting(), outdir=tmp_path, timeout=1
+    )
+    assert time.monotonic() - start < 30
+    assert result.timed_out
+    assert_cleaned_up(stub_log)
+
+
+def test_cancel_kills_process_tree(stub_log, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "600")
+
+    async def cancel():
+        task = asyncio.create_task(
+            CreduceReducer("cvise").run_async(
+                program(), AlwaysInteresting(), outdir=tmp_path, timeout=None
+            )
+        )
+        await asyncio.sleep(1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert_cleaned_up(stub_log)
+
+
+def test_pass_timeout_schedule(stub_log, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "600")
+    pass_group_file = tmp_path / "passes.json"
+    with open(pass_group_file, "w") as f:
+        json.dump(
+            {
+                "first": [{"pass": "a"}],
+                "main": [{"pass": "b"}, {"pass": "c"}],
+                "last": [],
+            },
+            f,
+        )
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+
+    result = CreduceReducer("cvise").run(
+        program(),
+        AlwaysInteresting(),
+        outdir=outdir,
+        timeout=60,
+        pass_group_file=pass_group_file,
+        pass_timeout=3,
+    )
+    # passes running into their timeout do not stop the reduction
+    assert not result.timed_out
+    args = lines(stub_log / "args")
+    assert len(args) == 3
+    for call, name in zip(args, ["pass_first_0", "pass_main_0", "pass_main_1"]):
+        assert f"--pass-group-file {outdir / name}.json" in call
+    assert result.tests == 9
+    assert_cleaned_up(stub_log)
@@ -0,0 +1,50 @@
+import shutil
+
+import pytest
+from diopter.compiler import Language, SourceProgram
+
+from utils import _compile_batch, get_binary_size, get_binary_sizes, make_setting
+
+pytestmark = pytest.mark.skipif(shutil.which("gcc") is None, reason="needs gcc")
+
+
+def program(code: str) -> SourceProgram:
+    return SourceProgram(code=code, language=Language.C)
+
+
+@pytest.fixture
+def setting():
+    return make_setting("gcc", "O0", flags=())
+
+
+def test_batch_sizes_match_single_compiles(setting):
+    programs = [program(f"int f(int x) {{ return x * {i} + {i}; }}") for i in range(6)]
+    programs.append(
+        program("int g(int *a, int n) { int s = 0; while (n--) s += a[n]; return s; }")
+    )
+    assert get_binary_sizes(programs, setting, jobs=2) == [
+        get_binary_size(p, setting) for p in programs
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_broken_programs_in_batch(setting, jobs):
+    programs = [program(f"int f{i}(int x) {{ return x * {i}; }}") for i in range(10)]
+    programs[3] = program("int f( {")
+    programs[7] = program("syntax error")
+
+    sizes = get_binary_sizes(programs, setting, jobs=jobs)
+    for i, (p, size) in enumerate(zip(programs, sizes)):
+        if i in (3, 7):
+            assert size is None
+        else:
+            assert size == get_binary_size(p, setting)
+
+
+def test_all_programs_broken(setting):
+    programs = [program("int f( {"), program("syntax error"), program("}")]
+    assert _compile_batch(programs, [0, 1, 2], setting, None) == [None, None, None]
+
+
+def test_empty(setting):
+    assert get_binary_sizes([], setting) == []
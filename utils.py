@@ -1,15 +1,24 @@
 import json
 import os
 import logging
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from multiprocessing import cpu_count
 from pathlib import Path
 import argparse
 from datetime import datetime
 from types import SimpleNamespace
 from diopter.compiler import (
     CompilationSetting,
+    CompilerExe,
+    Language,
     ObjectCompilationOutput,
+    OptLevel,
     SourceProgram,
 )
+from diopter.utils import run_cmd
 
 
 class ExperimentDirEnv:
@@ -25,12 +34,12 @@ class ExperimentDirEnv:
         self.path = experiment_path
 
     def __enter__(self):
-        self.old_dir = Path(os.getcwd()).absolute()
-        os.chdir(self.path)
+        # the working directory is process global, so it is not changed here;
+        # use the returned absolute path instead
         return self.path
 
     def __exit__(self, t, v, tb):
-        os.chdir(self.old_dir)
+        pass
 
 
 class NestedNamespace(SimpleNamespace):
@@ -43,19 +52,189 @@ class NestedNamespace(SimpleNamespace):
                 self.__setattr__(key, value)
 
 
-def get_binary_size(program: SourceProgram, setting: CompilationSetting):
+def make_setting(compiler: str, opt_level: str, flags=("-march=native",)):
+    """CompilationSetting for the system "gcc" or "clang" """
+    compiler_exe = {
+        "gcc": CompilerExe.get_system_gcc,
+        "clang": CompilerExe.get_system_clang,
+    }[compiler]()
+    return CompilationSetting(
+        compiler=compiler_exe,
+        opt_level=OptLevel.from_str(opt_level),
+        flags=tuple(flags),
+    )
+
+
+def compilation_cmd(
+    setting: CompilationSetting,
+    language_flags: tuple[str, ...] = (),
+    program_flags: tuple[str, ...] = (),
+) -> list[str]:
+    """Compiler invocation for `setting` without inputs and outputs.
+
+    Same flag order as diopter's CompilationSetting.get_compilation_cmd, which
+    compile_program uses, for invocations it cannot build (several inputs,
+    precompiled headers).
+    """
+    return [
+        str(setting.compiler.exe),
+        f"-{setting.opt_level.name}",
+        *language_flags,
+        *setting.flags,
+        *(f"-I{path}" for path in setting.include_paths),
+        *(f"-isystem{path}" for path in setting.system_include_paths),
+        *(f"-D{macro}" for macro in setting.macro_definitions),
+        *program_flags,
+    ]
+
+
+def get_binary_size(program: SourceProgram, setting: CompilationSetting, preamble=None):
+    """.text size of `program`, compiled against the PrecompiledPreamble
+    `preamble` if given and applicable"""
+    if preamble is not None:
+        binary_size = preamble.get_binary_size(program)
+        if binary_size is not None:
+            return binary_size
     return setting.compile_program(
         program, ObjectCompilationOutput(None)
     ).output.text_size()
 
 
-def get_ratio(program: SourceProgram, setting: CompilationSetting):
+def get_ratio(program: SourceProgram, setting: CompilationSetting, preamble=None):
+    # always relative to the full program text, also if compiled with a preamble
     source_size = len(program.code)
 
-    binary_size = get_binary_size(program, setting)
+    binary_size = get_binary_size(program, setting, preamble)
     return binary_size / source_size
 
 
+def get_binary_sizes(
+    programs: list[SourceProgram],
+    setting: CompilationSetting,
+    batch_size: int = 64,
+    timeout: int | None = None,
+    jobs: int | None = None,
+) -> list[int | None]:
+    """.text sizes of many programs using as few compiler invocations as possible.
+
+    Programs with the same language and flags are compiled together with a
+    single `-c` invocation into a scratch directory, up to `jobs` batches
+    run in parallel. If a batch fails it is split in half until the failing
+    programs are isolated, their size is None.
+    """
+    jobs = jobs if jobs else cpu_count()
+    sizes: list[int | None] = [None] * len(programs)
+
+    def batch_key(i):
+        return (programs[i].language.value, programs[i].get_compilation_flags())
+
+    indices = sorted(range(len(programs)), key=batch_key)
+    batches = []
+    for _, group in groupby(indices, key=batch_key):
+        group = list(group)
+        # spread small inputs over all cores instead of filling one batch
+        size = min(batch_size, -(-len(group) // jobs))
+        batches += [group[start : start + size] for start in range(0, len(group), size)]
+
+    with ThreadPoolExecutor(jobs) as executor:
+        results = executor.map(
+            lambda batch: _compile_batch(programs, batch, setting, timeout), batches
+        )
+        for batch, batch_sizes in zip(batches, results):
+            for i, size in zip(batch, batch_sizes):
+                sizes[i] = size
+    return sizes
+
+
+def _compile_batch(
+    programs: list[SourceProgram],
+    batch: list[int],
+    setting: CompilationSetting,
+    timeout: int | None,
+) -> list[int | None]:
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        source_files = []
+        for i in batch:
+            source_file = scratch / f"p{i}{programs[i].language.to_suffix()}"
+            source_file.write_text(programs[i].get_modified_code())
+            source_files.append(source_file)
+
+        first = programs[batch[0]]
+        cmd = compilation_cmd(
+            setting,
+            (first.language.get_language_flag(),),
+            first.get_compilation_flags(),
+        ) + ["-c", *(str(f) for f in source_files)]
+        object_files = [f.with_suffix(".o") for f in source_files]
+        try:
+            run_cmd(
+                cmd,
+                working_dir=scratch,
+                additional_env={"TMPDIR": tempfile.gettempdir()},
+                timeout=timeout,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            if len(batch) == 1:
+                return [None]
+            # the driver keeps compiling after a failing input, the inputs
+            # that got no object file are retried in smaller batches
+            built = isinstance(e, subprocess.CalledProcessError)
+            done = [built and f.exists() for f in object_files]
+            failed = [i for i, ok in zip(batch, done) if not ok]
+            if len(failed) == len(batch):
+                middle = len(batch) // 2
+                return _compile_batch(
+                    programs, batch[:middle], setting, timeout
+                ) + _compile_batch(programs, batch[middle:], setting, timeout)
+
+            retried = iter(_compile_batch(programs, failed, setting, timeout))
+            done_sizes = iter(
+                _text_sizes([f for f, ok in zip(object_files, done) if ok])
+            )
+            return [next(done_sizes) if ok else next(retried) for ok in done]
+
+        return _text_sizes(object_files)
+
+
+def _text_sizes(object_files: list[Path]) -> list[int]:
+    if not object_files:
+        return []
+    # `size` prints a header and one "text data bss dec hex filename" line per file
+    size_output = run_cmd(["size", *(str(f) for f in object_files)]).stdout
+    return [int(line.split()[0]) for line in size_output.splitlines()[1:]]
+
+
+def get_ratios(
+    programs: list[SourceProgram], setting: CompilationSetting, batch_size: int = 64
+) -> list[float | None]:
+    return [
+        size / len(p.code) if size is not None else None
+        for p, size in zip(programs, get_binary_sizes(programs, setting, batch_size))
+    ]
+
+
+def get_best_program(program_dir: str, setting: CompilationSetting):
+    programs = []
+    for file in os.listdir(program_dir):
+        with open(os.path.join(program_dir, file), "r") as f:
+            programs.append(
+                SourceProgram(
+                    code=f.read(),
+                    language=Language.C,
+                )
+            )
+
+    best_ratio = 0
+    best_program = None
+    for p, current_ratio in zip(programs, get_ratios(programs, setting)):
+        if current_ratio is not None and current_ratio > best_ratio:
+            best_ratio = current_ratio
+            best_program = p
+
+    return best_program, best_ratio
+
+
 def get_config_and_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, help="Path to config file")
@@ -1,24 +1,25 @@
 import json
-import logging
 import os
 import re
-import subprocess
-from dataclasses import replace
-from multiprocessing import cpu_count
-from pathlib import Path
-from shutil import which
-from sys import stderr
+import time
 from typing import TextIO
 
-from diopter.compiler import (CompilationSetting, CompilerExe, Language,
-                              ObjectCompilationOutput, OptLevel, SourceProgram)
-from diopter.reducer import (Reducer, ReductionCallback,
-                             make_interestingness_script)
+from diopter.compiler import (
+    CompilationSetting,
+    CompilerExe,
+    Language,
+    ObjectCompilationOutput,
+    OptLevel,
+    SourceProgram,
+)
+from diopter.reducer import ReductionCallback
 from diopter.sanitizer import Sanitizer
-from diopter.utils import TempDirEnv, run_cmd_to_logfile
 
 from static_globals.instrumenter import annotate_with_static
 
+from predictor import RatioPredictor, extract_features, record_observation
+from reducer import CreduceReducer
+
 
 def get_binary_size(program: SourceProgram, setting: CompilationSetting) -> int:
     """Use diopter to get .text size of program"""
@@ -29,7 +30,7 @@ def get_binary_size(program: SourceProgram, setting: CompilationSetting) -> int:
 
 def get_code_size(program: SourceProgram) -> int:
     """Calculate number of words of size of SourceProgram filtering all,
-      that don't start with alpha"""
+    that don't start with alpha"""
     # return len([p for p in program.code.split() if re.match("^[a-zA-Z_]", p)])
     return len(program.code)
 
@@ -39,7 +40,9 @@ def get_ratio(program: SourceProgram, setting: CompilationSetting) -> float:
     return (get_binary_size(program, setting)) / get_code_size(program)
 
 
-def filter(program: SourceProgram, comp: CompilationSetting, target_ratio: float) -> float:
+def filter(
+    program: SourceProgram, comp: CompilationSetting, target_ratio: float
+) -> float:
     """Returns True if code size to binary size ratio is bigger than target ratio."""
     return get_ratio(program, comp) >= target_ratio
 
@@ -51,8 +54,8 @@ def read_sourcefile(file_path: str) -> SourceProgram:
     return SourceProgram(code=code, language=Language.C)
 
 
-class ReducerWithArgs(Reducer):
-    """Copy of diopter Reducer class, with simple option to change pass_group_file manually"""
+class ReducerWithArgs(CreduceReducer):
+    """CreduceReducer with a fixed pass_group_file and no timeout by default"""
 
     def __init__(self, pass_group_file: str, creduce: str | None = None):
         """
@@ -62,9 +65,8 @@ class ReducerWithArgs(Reducer):
             creduce (str | None):
             path to the creduce binary, if empty "creduce" will be used
         """
+        super().__init__(creduce)
         self.pass_group_file = pass_group_file
-        self.creduce = creduce if creduce else "creduce"
-        assert which(self.creduce), f"{self.creduce} is not executable"
 
     def reduce(
         self,
@@ -73,95 +75,96 @@ class ReducerWithArgs(Reducer):
         jobs: int | None = None,
         log_file: TextIO | None = None,
         debug: bool = False,
+        timeout: float | None = None,
+        pass_timeout: float | None = None,
     ) -> SourceProgram | None:
-        """
-        Reduce `program` according to the `interestingness_test`
-
-        Args:
-            program (SourceProgram):
-                the program to reduce
-            interestingness_test (ReductionCallback):
-                a concrete ReductionCallback that implementes the interestingness
-            jobs (int|None):
-                The number of Creduce jobs, if empty cpu_count() will be
-            log_file (TextIO | None):
-                Where to log Creduce's output, if empty stderr will be used
-            debug (bool):
-                Whether to pass the debug flag to creduce
-
-        Returns:
-            (SourceProgram |None):
-                Reduced program, if successful.
-        """
-        creduce_jobs = jobs if jobs else cpu_count()
-
-        code_filename = "code" + program.language.to_suffix()
-
-        interestingness_script = make_interestingness_script(
-            interestingness_test, program, code_filename
+        return super().reduce(
+            program,
+            interestingness_test,
+            jobs=jobs,
+            timeout=timeout,
+            pass_group_file=self.pass_group_file,
+            pass_timeout=pass_timeout,
+            log_file=log_file,
+            debug=debug,
         )
 
-        # creduce likes to kill unfinished processes with SIGKILL
-        # so they can't clean up after themselves.
-        # Setting a temporary temporary directory for creduce to be able to clean
-        # up everything
-        with TempDirEnv() as tmpdir:
-            code_file = tmpdir / code_filename
-            with open(code_file, "w") as f:
-                f.write(program.code)
-
-            script_path = tmpdir / "check.py"
-            with open(script_path, "w") as f:
-                print(interestingness_script, file=f)
-            os.chmod(script_path, 0o770)
-            # run creduce
-            creduce_cmd = [
-                self.creduce,
-                "--n",
-                f"{creduce_jobs}",
-                "--pass-group-file",
-                f"{self.pass_group_file}",
-                str(script_path.name),
-                str(code_file.name),
-            ]
-            if debug:
-                creduce_cmd.append("--debug")
-
-            try:
-                run_cmd_to_logfile(
-                    creduce_cmd,
-                    log_file=log_file if log_file else stderr,
-                    working_dir=Path(tmpdir),
-                    additional_env={"TMPDIR": str(tmpdir.absolute())},
-                )
-            except subprocess.CalledProcessError as e:
-                logging.info(f"Failed to reduce code. Exception: {e}")
-                return None
-
-            with open(code_file, "r") as f:
-                reduced_code = f.read()
-
-            return replace(program, code=reduced_code)
-
 
 class ReduceRatio(ReductionCallback):
     target_ratio: float
 
-    def __init__(self, san: Sanitizer, comp: CompilationSetting, target_ratio: float):
+    def __init__(
+        self,
+        san: Sanitizer,
+        comp: CompilationSetting,
+        target_ratio: float,
+        predictor: RatioPredictor | None = None,
+        log_file: str | None = None,
+    ):
         self.san = san
         self.comp = comp
         self.target_ratio = target_ratio
+        self.predictor = predictor
+        self.log_file = os.path.realpath(log_file) if log_file else None
 
     def test(self, program: SourceProgram) -> bool:
+        features = None
+        if self.predictor or self.log_file:
+            features = extract_features(program.code)
+        predicted, prescreen = None, None
+        if self.predictor:
+            predicted, prescreen = self.predictor.prescreen(features, self.target_ratio)
+            if prescreen == "reject":
+                if self.log_file:
+                    record_observation(
+                        self.log_file,
+                        features,
+                        None,
+                        self.target_ratio,
+                        False,
+                        predicted,
+                        prescreen,
+                    )
+                return False
+
         program = annotate_with_static(program)
-        if not self.san.sanitize(program):
-            return False
-        if get_binary_size(program, self.comp) <= 100:
+        start = time.monotonic()
+        sanitized = self.san.sanitize(program)
+        sanitize_time = time.monotonic() - start
+        if not sanitized:
+            if self.log_file:
+                record_observation(
+                    self.log_file,
+                    features,
+                    None,
+                    self.target_ratio,
+                    False,
+                    predicted,
+                    prescreen,
+                    sanitize_time=sanitize_time,
+                )
             return False
-        return filter(program, self.comp, self.target_ratio)
+        start = time.monotonic()
+        binary_size = get_binary_size(program, self.comp)
+        compile_time = time.monotonic() - start
+        ratio = binary_size / get_code_size(program)
+        accepted = binary_size > 100 and ratio >= self.target_ratio
+        if self.log_file:
+            record_observation(
+                self.log_file,
+                features,
+                ratio,
+                self.target_ratio,
+                accepted,
+                predicted,
+                prescreen,
+                sanitize_time=sanitize_time,
+                compile_time=compile_time,
+            )
+        return accepted
 
     def update_target_ratio(self, target_ratio: int):
-        if (self.target_ratio < target_ratio):
+        if self.target_ratio < target_ratio:
             raise ValueError("target_size cannot be bigger than previous one")
         self.target_ratio = target_ratio
 
@@ -174,7 +177,28 @@ def get_standard_compiler_settings() -> CompilationSetting:
         flags=("-march=native",),
     )
 
+
 def write_pass_file(path, first=[], main=[], last=[]):
     pas = {"first": first, "main": main, "last": last}
     with open(path, "w") as f:
         json.dump(pas, f)
+
+
+def write_fast_pass_file(path, default_options_file, fast_maybe_useful_file):
+    """Pass group with only the fast passes, in the order of the default schedule"""
+    with open(default_options_file) as f:
+        default_options = json.load(f)
+    with open(fast_maybe_useful_file) as f:
+        fast_maybe_useful = json.load(f)
+
+    fast_options = []
+    # take order of default options for fast ones -> to be faster
+    for option in default_options["first"]:
+        if option in fast_maybe_useful:
+            fast_options.append(option)
+    # add all other options (skip all non-last things)
+    for option in fast_maybe_useful:
+        if (option not in fast_options) and (option not in default_options["last"]):
+            fast_options.append(option)
+
+    write_pass_file(path, first=fast_options)